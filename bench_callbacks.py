@@ -0,0 +1,70 @@
+"""Микробенчмарк маршрутизации callback_data: цепочка F-фильтров против CallbackRouter.
+
+Меряется только выбор хендлера и разбор payload (без сети и FSM):
+    python bench_callbacks.py [итераций]
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")  # main требует токен; к Bot API не обращаемся
+
+from aiogram import F
+from aiogram.types import CallbackQuery, User
+
+import main
+
+SAMPLES = [
+    "fp:mv", "dest_page:1", "dest_pick:пятигорск", "calnav:2026:11", "calpick:2026:11:5",
+    "calpick:today", "timeh:09", "timem:09:30", "pax:3", "pax:7+", "comment_no",
+    "order_confirm", "dispatcher_phone", "calcancel", "timeback", "noop",
+]
+
+# Фильтры и разбор в том порядке, в каком они стояли в хендлерах до CallbackRouter
+OLD_CHAIN = [
+    (F.data == "dispatcher_phone", lambda d: None),
+    (F.data.startswith("fp:"), lambda d: d.split(":", 1)[1]),
+    (F.data.startswith("dest_page:"), lambda d: int(d.split(":", 1)[1])),
+    (F.data.startswith("dest_pick:"), lambda d: d.split(":", 1)[1]),
+    (F.data == "calcancel", lambda d: None),
+    (F.data.startswith("calnav:"), lambda d: tuple(map(int, d.split(":")[1:]))),
+    (F.data.startswith("calpick:"), lambda d: d.split(":")),
+    (F.data == "timecancel", lambda d: None),
+    (F.data == "timeback", lambda d: None),
+    (F.data.startswith("timeh:"), lambda d: d.split(":", 1)[1]),
+    (F.data.startswith("timem:"), lambda d: d.split(":")),
+    (F.data.startswith("pax:"), lambda d: d.split(":", 1)[1]),
+    (F.data == "comment_yes", lambda d: None),
+    (F.data == "comment_no", lambda d: None),
+    (F.data.in_(["order_confirm", "order_edit", "order_cancel"]), lambda d: d),
+]
+
+def old_route(cb: CallbackQuery):
+    for flt, parse in OLD_CHAIN:
+        if flt.resolve(cb):
+            return parse(cb.data)
+    return None
+
+def new_route(cb: CallbackQuery):
+    return main.callback_router.resolve(cb.data)
+
+def bench(route, events, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for cb in events:
+            route(cb)
+    return iterations * len(events) / (time.perf_counter() - started)
+
+def main_bench(iterations: int) -> None:
+    user = User(id=1, is_bot=False, first_name="bench")
+    events = [CallbackQuery(id=str(i), from_user=user, chat_instance="bench", data=d) for i, d in enumerate(SAMPLES)]
+    for route in (old_route, new_route):
+        bench(route, events, max(1, iterations // 10))  # прогрев
+    old = bench(old_route, events, iterations)
+    new = bench(new_route, events, iterations)
+    print(f"filter chain:    {old:12,.0f} callbacks/s")
+    print(f"CallbackRouter:  {new:12,.0f} callbacks/s  (x{new / old:.1f})")
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+    main.log_listener.stop()
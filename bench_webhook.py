@@ -0,0 +1,68 @@
+"""Микробенчмарк приёма вебхука: CPU на один запрос до и после быстрого пути.
+
+Меряется разбор тела, валидация Update и сериализация ответа (без хендлеров):
+    python bench_webhook.py [итераций]
+"""
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")  # main требует токен; к Bot API не обращаемся
+
+from aiogram.types import Update
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+
+USER = {"id": 42, "is_bot": False, "first_name": "U", "language_code": "ru"}
+CHAT = {"id": 42, "type": "private", "first_name": "U"}
+PAYLOADS = {
+    "callback_query": {"update_id": 1, "callback_query": {
+        "id": "1", "chat_instance": "c", "data": "timem:09:30", "from": USER,
+        "message": {
+            "message_id": 1, "date": 1700000000, "chat": CHAT, "text": "Минуты:",
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            "reply_markup": {"inline_keyboard": [
+                [{"text": m, "callback_data": f"timem:09:{m}"} for m in ("00", "15", "30", "45")],
+                [{"text": "Отмена", "callback_data": "timecancel"}],
+            ]},
+        },
+    }},
+    "message": {"update_id": 2, "message": {
+        "message_id": 2, "date": 1700000000, "chat": CHAT, "from": USER, "text": "+7 999 123-45-67",
+    }},
+    "edited_message (unhandled)": {"update_id": 3, "edited_message": {
+        "message_id": 3, "date": 1700000000, "edit_date": 1700000001, "chat": CHAT, "from": USER, "text": "x",
+    }},
+}
+
+def old_ingest(body: bytes):
+    update = Update.model_validate(json.loads(body))
+    # так делал feed_update для Update без привязанного бота
+    update = Update.model_validate(update.model_dump(), context={"bot": main.bot})
+    return JSONResponse(jsonable_encoder({"ok": True})).body
+
+def new_ingest(body: bytes):
+    main.parse_update(body)
+    return main.ok_response().body
+
+def bench(fn, body: bytes, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(body)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def main_bench(iterations: int) -> None:
+    for name, payload in PAYLOADS.items():
+        body = json.dumps(payload).encode()
+        for fn in (old_ingest, new_ingest):
+            bench(fn, body, max(1, iterations // 10))  # прогрев
+        old = bench(old_ingest, body, iterations)
+        new = bench(new_ingest, body, iterations)
+        print(f"{name:28} old {old:8.1f} us   new {new:8.1f} us   saved {old - new:8.1f} us/request")
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    main.log_listener.stop()
@@ -0,0 +1,175 @@
+"""Офлайн-геокодер: компактный индекс населённых пунктов из дампа GeoNames.
+
+Сборка (один раз, без сети):
+    python geoindex.py RU.txt geonames.idx [--countries RU,GE,AM,AZ] [--bbox 40,36,49.5,50]
+
+Формат файла индекса (little-endian):
+    заголовок   MAGIC (8 байт) + число ключей N (uint32)
+    смещения    N+1 x uint32 — границы ключей в блоке ключей
+    записи      N x (lat float32, lon float32, population uint32)
+    ключи       нормализованные имена (ASCII), отсортированы побайтно
+
+Файл открывается через mmap и не копируется в память; поиск — бинарный, O(log N).
+"""
+import argparse
+import mmap
+import re
+import struct
+import sys
+import unicodedata
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+MAGIC = b"GNIX3\0\0\0"  # версия меняется вместе с normalize_name
+HEADER = struct.Struct("<8sI")
+OFFSET = struct.Struct("<I")
+RECORD = struct.Struct("<ffI")
+
+# Юг России и Кавказ
+DEFAULT_COUNTRIES = ("RU", "GE", "AM", "AZ")
+DEFAULT_BBOX = (40.0, 36.0, 49.5, 50.0)  # lat_min, lon_min, lat_max, lon_max
+
+# Транслитерация BGN/PCGN — так записаны name/asciiname в GeoNames («Yessentuki», «Nal'chik»).
+# е/ё в начале слова, после гласной, ъ и ь дают «ye» (см. _YE_RE), в остальных позициях — «e»
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya",
+}
+_TRANSLIT_TABLE = str.maketrans(TRANSLIT)
+_YE_RE = re.compile(r"(?:(?<=[аеёиоуыэюяъь])|(?<![а-яё]))[её]")
+# Апострофы и кавычки на месте ь/ъ (ʹ, ʺ, ", ') удаляются, а не разделяют слова: Nal'chik -> nalchik
+_APOSTROPHES_RE = re.compile(r"['’ʹʺ\"`]")
+_NON_KEY_RE = re.compile(r"[^a-z0-9]+")
+_NON_ASCII_LETTER_RE = re.compile(r"[^\W\d_a-z]")
+_ALLOWED_NAME_RE = re.compile(r"^[A-Za-zА-Яа-яЁё0-9\s\-'’.()]+$")
+
+# Служебные слова в названиях («село», «станица»…), которые не участвуют в ключе
+STOP_WORDS = {"g", "gorod", "selo", "stanitsa", "aul", "poselok", "pos", "pgt", "khutor", "derevnya"}
+
+def normalize_name(text: str) -> str:
+    # «Нальчик», «Nal'chik» и «nalchik» дают один ключ; «Ессентуки» и «Yessentuki» — тоже.
+    # Диакритика снимается после кириллицы (иначе й и ё распались бы на и/е + знак): Orël -> orel.
+    # Если остались буквы вне a-z (ə, ß, грузинское письмо…), ключа нет: обрубок вроде «nc»
+    # из «Gəncə» совпал бы с чужим коротким вводом
+    text = _YE_RE.sub("ye", _APOSTROPHES_RE.sub("", (text or "").lower())).translate(_TRANSLIT_TABLE)
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    if _NON_ASCII_LETTER_RE.search(text):
+        return ""
+    key = _NON_KEY_RE.sub(" ", text).split()
+    words = [w for w in key if w not in STOP_WORDS]
+    return " ".join(words or key)
+
+def _iter_names(row: Sequence[str]) -> Iterable[str]:
+    yield row[1]
+    yield row[2]
+    for alt in row[3].split(","):
+        if alt and _ALLOWED_NAME_RE.match(alt):
+            yield alt
+
+def build_index(
+    dump_path: str,
+    out_path: str,
+    countries: Sequence[str] = DEFAULT_COUNTRIES,
+    bbox: Tuple[float, float, float, float] = DEFAULT_BBOX,
+    feature_classes: Sequence[str] = ("P",),
+) -> int:
+    lat_min, lon_min, lat_max, lon_max = bbox
+    wanted_countries = set(countries)
+    wanted_classes = set(feature_classes)
+    best: Dict[bytes, Tuple[float, float, int]] = {}
+
+    with open(dump_path, encoding="utf-8") as f:
+        for line in f:
+            row = line.rstrip("\n").split("\t")
+            if len(row) < 15 or row[6] not in wanted_classes or row[8] not in wanted_countries:
+                continue
+            try:
+                lat, lon = float(row[4]), float(row[5])
+                population = int(row[14] or 0)
+            except ValueError:
+                continue
+            if not (lat_min <= lat <= lat_max and lon_min <= lon <= lon_max):
+                continue
+            for name in _iter_names(row):
+                key = normalize_name(name).encode("ascii")
+                if not key:
+                    continue
+                # Одинаковые имена — оставляем самый крупный населённый пункт
+                current = best.get(key)
+                if current is None or population > current[2]:
+                    best[key] = (lat, lon, population)
+
+    keys = sorted(best)
+    with open(out_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, len(keys)))
+        pos = 0
+        for key in keys:
+            out.write(OFFSET.pack(pos))
+            pos += len(key)
+        out.write(OFFSET.pack(pos))
+        for key in keys:
+            out.write(RECORD.pack(*best[key]))
+        for key in keys:
+            out.write(key)
+    return len(keys)
+
+class GeoIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path}: not a geo index")
+        self._offsets = HEADER.size
+        self._records = self._offsets + (self.count + 1) * OFFSET.size
+        self._keys = self._records + self.count * RECORD.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _key(self, i: int) -> bytes:
+        start, end = struct.unpack_from("<II", self._mm, self._offsets + i * OFFSET.size)
+        return self._mm[self._keys + start:self._keys + end]
+
+    def lookup(self, name: str) -> Optional[Tuple[float, float, int]]:
+        # (lat, lon, population) или None
+        key = normalize_name(name).encode("ascii")
+        if not key:
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            return RECORD.unpack_from(self._mm, self._records + lo * RECORD.size)
+        return None
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+def parse_bbox(text: str) -> Tuple[float, float, float, float]:
+    lat_min, lon_min, lat_max, lon_max = (float(x) for x in text.split(","))
+    return lat_min, lon_min, lat_max, lon_max
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build a compact GeoNames index for the offline geocoder")
+    parser.add_argument("dump", help="GeoNames dump (e.g. RU.txt or allCountries.txt)")
+    parser.add_argument("out", help="output index file")
+    parser.add_argument("--countries", default=",".join(DEFAULT_COUNTRIES))
+    parser.add_argument("--bbox", default=",".join(str(x) for x in DEFAULT_BBOX),
+                        help="lat_min,lon_min,lat_max,lon_max")
+    args = parser.parse_args(argv)
+    n = build_index(args.dump, args.out, args.countries.split(","), parse_bbox(args.bbox))
+    print(f"{args.out}: {n} names")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,21 +2,53 @@ import os
 import math
 import asyncio
 import logging
+import logging.handlers
+import json
+import heapq
+import queue
+import signal
+import random
 import re
+import sys
+import time
+import marshal
+import threading
+import traceback
+import contextvars
+import copy
+import urllib.request
 import calendar as pycal
-from datetime import date, timedelta
-from typing import Final, Dict, Optional, Tuple, List
-
-from fastapi import FastAPI, Request, HTTPException
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart
+from array import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Final, Deque, Dict, Optional, Tuple, List, Any, Awaitable, Callable, NamedTuple
+
+import orjson
+from fastapi import FastAPI, Request, HTTPException, Response
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNetworkError, TelegramServerError,
+)
 from aiogram.types import (
     Update, Message, BotCommand, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, TelegramObject, User
 )
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
 import aiohttp
+from aiohttp import ClientSession, TraceConfig
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from geoindex import GeoIndex, build_index, parse_bbox, DEFAULT_BBOX, DEFAULT_COUNTRIES
 
 # ================== CONFIG ==================
 BOT_TOKEN: Final[str] = os.getenv("BOT_TOKEN", "")
@@ -27,16 +59,634 @@ ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "7039409310") or 7039409310)
 DISPATCHER_PHONE = "+79340241414"
 DISPATCHER_NAME = "Диспетчер TransferAir"
 
+# Антифлуд: дешёвые события (кнопки, меню) и дорогие (расчёт цены с геокодером)
+RATE_CHEAP_PER_SEC = float(os.getenv("RATE_CHEAP_PER_SEC", "2") or 2)
+RATE_CHEAP_BURST = int(os.getenv("RATE_CHEAP_BURST", "10") or 10)
+RATE_QUOTE_PER_MIN = float(os.getenv("RATE_QUOTE_PER_MIN", "6") or 6)
+RATE_QUOTE_BURST = int(os.getenv("RATE_QUOTE_BURST", "3") or 3)
+RATE_MAX_USERS = int(os.getenv("RATE_MAX_USERS", "10000") or 10000)
+
+# Остановка по SIGTERM: сколько секунд отвечать 503 (и not ready), прежде чем uvicorn закроет порт,
+# и сколько потом ждать фоновые исходящие сообщения. Незавершённые запросы ждёт сам uvicorn
+# (--timeout-graceful-shutdown). Сумма всех трёх должна укладываться в grace period платформы.
+SHUTDOWN_READINESS_DELAY = float(os.getenv("SHUTDOWN_READINESS_DELAY", "3") or 3)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "10") or 10)
+# Режим перезапуска: вебхук не снимаем и очередь апдейтов Telegram не сбрасываем
+ROLLING_RESTART = os.getenv("ROLLING_RESTART", "0").lower() in ("1", "true", "yes")
+# Последний вызов Bot API хендлера (если он его возвращает) отдаём телом ответа вебхука
+WEBHOOK_REPLY = os.getenv("WEBHOOK_REPLY", "1").lower() in ("1", "true", "yes")
+
+# FSM: через сколько секунд бездействия забываем брошенный диалог и как часто чистим
+FSM_IDLE_TTL = float(os.getenv("FSM_IDLE_TTL", "21600") or 21600)
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "60") or 60)
+
+# Расчёт цены: общий бюджет времени на все запросы геокодера и кэш результатов
+QUOTE_BUDGET = float(os.getenv("QUOTE_BUDGET", "2") or 2)
+GEOCODE_HTTP_TIMEOUT = float(os.getenv("GEOCODE_HTTP_TIMEOUT", "10") or 10)
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", "86400") or 86400)
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", "300") or 300)
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "5000") or 5000)
+# Предохранитель Nominatim: после N ошибок подряд не ходим в сеть cooldown секунд
+GEOCODE_CIRCUIT_FAILURES = int(os.getenv("GEOCODE_CIRCUIT_FAILURES", "5") or 5)
+GEOCODE_CIRCUIT_COOLDOWN = float(os.getenv("GEOCODE_CIRCUIT_COOLDOWN", "60") or 60)
+
+# Геокодеры по порядку: офлайн-индекс GeoNames, затем Nominatim как запасной
+GEOCODER_BACKENDS = [b.strip() for b in os.getenv("GEOCODER_BACKENDS", "geonames,nominatim").split(",") if b.strip()]
+GEONAMES_INDEX = os.getenv("GEONAMES_INDEX", "geonames.idx")
+GEONAMES_DUMP = os.getenv("GEONAMES_DUMP", "")  # если индекса нет — соберём его из дампа при старте
+GEONAMES_COUNTRIES = os.getenv("GEONAMES_COUNTRIES", ",".join(DEFAULT_COUNTRIES)).split(",")
+GEONAMES_BBOX = parse_bbox(os.getenv("GEONAMES_BBOX", ",".join(str(x) for x in DEFAULT_BBOX)))
+
+# Данные на диске: реестр пользователей и состояние рассылки
+DATA_DIR = os.getenv("DATA_DIR", "data")
+# Рассылка: сообщений в секунду (лимит Telegram ~30/с) и размер пачки между чекпоинтами
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25") or 25)
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "25") or 25)
+
+# Напоминания о подаче: за сколько минут до подачи писать клиенту и диспетчеру (через запятую)
+REMINDER_LEADS_CUSTOMER = [int(x) for x in os.getenv("REMINDER_LEADS_CUSTOMER", "1440,120").split(",") if x.strip()]
+REMINDER_LEADS_DISPATCHER = [int(x) for x in os.getenv("REMINDER_LEADS_DISPATCHER", "60").split(",") if x.strip()]
+# Часовой пояс дат/времени в заявках (КМВ — UTC+3)
+PICKUP_TZ = timezone(timedelta(hours=float(os.getenv("PICKUP_UTC_OFFSET", "3") or 3)))
+# Отправка напоминаний: не больше N в секунду и M одновременно (после простоя их может скопиться много)
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "20") or 20)
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "10") or 10)
+
+# Пул соединений к api.telegram.org
+BOT_POOL_LIMIT = int(os.getenv("BOT_POOL_LIMIT", "100") or 100)
+BOT_POOL_LIMIT_PER_HOST = int(os.getenv("BOT_POOL_LIMIT_PER_HOST", "100") or 100)
+BOT_KEEPALIVE = float(os.getenv("BOT_KEEPALIVE", "30") or 30)
+BOT_DNS_TTL = int(os.getenv("BOT_DNS_TTL", "300") or 300)
+BOT_TIMEOUT = float(os.getenv("BOT_TIMEOUT", "30") or 30)
+# Таймауты по методам: "answerCallbackQuery=5,sendMessage=15"
+BOT_METHOD_TIMEOUTS = {
+    name.strip(): float(value)
+    for name, _, value in (item.partition("=") for item in os.getenv(
+        "BOT_METHOD_TIMEOUTS", "answerCallbackQuery=5,sendMessage=15,editMessageText=15").split(","))
+    if name.strip() and value
+}
+
+# Логи: уровень, размер очереди и доля сохраняемых «массовых» записей (0..1)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000") or 10000)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1") or 0.1)
+
+# Трассировка: доля апдейтов с трассой (0 — выключено) и куда писать спаны
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0") or 0)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "")  # например http://collector:4318/v1/traces
+
+# Профилировщик /debug/profile: период опроса стека (мс) и предельная длительность (сек)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5") or 5)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60") or 60)
+
+# Здоровье event loop: период замера задержки, порог «блокировки» (пишем стек в лог)
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.5") or 0.5)
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.5") or 0.5)
+# Готовность /readyz: допустимая задержка loop (сек), апдейтов в обработке, заполнение очереди логов (0..1)
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", "1") or 1)
+READY_MAX_INFLIGHT = int(os.getenv("READY_MAX_INFLIGHT", "200") or 200)
+READY_MAX_LOG_QUEUE = float(os.getenv("READY_MAX_LOG_QUEUE", "0.9") or 0.9)
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
 # ================== LOGGING ==================
-logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+# Запись в stderr идёт из фонового потока: event loop только кладёт запись в очередь
+log_update_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("log_update_id", default=None)
+log_chat_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("log_chat_id", default=None)
+log_handler: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_handler", default=None)
+
+# Логгеры, которые пишут на каждый апдейт — их INFO-записи сэмплируем
+SAMPLED_LOGGERS = ("aiogram.event",)
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+class LogContextFilter(logging.Filter):
+    # Выполняется в потоке вызывающего кода, пока контекст апдейта ещё доступен
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = log_update_id.get()
+        record.chat_id = log_chat_id.get()
+        record.handler = log_handler.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = getattr(record, "sample_rate", None)
+        if rate is None:
+            if not record.name.startswith(SAMPLED_LOGGERS):
+                return True
+            rate = self.rate
+        return rate >= 1.0 or random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("update_id", "chat_id", "handler"):
+            value = getattr(record, key, None)
+            if value is not None:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Переполненная очередь не должна тормозить обработку апдейтов — запись теряем
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь в том же процессе: pickle не нужен, поэтому в loop только подставляем
+        # аргументы в сообщение, а traceback форматирует JsonFormatter в потоке слушателя
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn настраивает свои логгеры до импорта приложения: синхронный вывод в stdout
+    # и propagate=False. Снимаем их обработчики — записи пойдут через общую очередь в JSON
+    for name in UVICORN_LOGGERS:
+        uv_logger = logging.getLogger(name)
+        uv_logger.handlers.clear()
+        uv_logger.propagate = True
+
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger("tgbot")
 
+# ================== ТРАССИРОВКА ==================
+# Спаны живут в contextvar; без активной трассы span() ничего не делает.
+# Экспорт — из фонового потока: в файл (JSON lines) и/или в OTLP/HTTP JSON коллектор.
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "error")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attrs: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attrs = attrs
+        self.error = False
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        out = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in self.attrs.items()],
+            "status": {"code": 2 if self.error else 1},
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        return out
+
+class SpanExporter:
+    def __init__(self, path: str, otlp_url: str, max_queue: int = 10000, batch: int = 256):
+        self.path = path
+        self.otlp_url = otlp_url
+        self.batch = batch
+        self.enabled = bool(path or otlp_url)
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def export(self, sp: Span) -> None:
+        try:
+            self._queue.put_nowait(sp)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            spans: List[Span] = []
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                spans.append(item)
+                if len(spans) >= self.batch:
+                    break
+                try:
+                    item = self._queue.get(timeout=1.0)
+                except queue.Empty:
+                    break
+            if spans:
+                self._flush(spans)
+
+    def _flush(self, spans: List[Span]) -> None:
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for sp in spans:
+                        f.write(json.dumps(sp.to_dict(), ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                logger.warning("Span export to %s failed: %s", self.path, e)
+        if self.otlp_url:
+            body = {"resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "tgbot"}}]},
+                "scopeSpans": [{"scope": {"name": "tgbot"}, "spans": [sp.to_otlp() for sp in spans]}],
+            }]}
+            req = urllib.request.Request(
+                self.otlp_url,
+                data=json.dumps(body).encode(),
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            try:
+                urllib.request.urlopen(req, timeout=5).close()
+            except Exception as e:
+                logger.warning("Span export to %s failed: %s", self.otlp_url, e)
+
+span_exporter = SpanExporter(TRACE_FILE, TRACE_OTLP_URL)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+class span:
+    # with span("geocode", city=city) as sp: ... — дочерний спан текущей трассы
+    __slots__ = ("name", "attrs", "_span", "_token", "_root")
+
+    def __init__(self, name: str, _root: bool = False, **attrs: Any):
+        self.name = name
+        self.attrs = attrs
+        self._span: Optional[Span] = None
+        self._token = None
+        self._root = _root
+
+    def __enter__(self) -> Optional[Span]:
+        parent = _current_span.get()
+        if parent is not None:
+            self._span = Span(parent.trace_id, parent.span_id, self.name, self.attrs)
+        elif self._root and span_exporter.enabled and random.random() < TRACE_SAMPLE_RATE:
+            self._span = Span("%032x" % random.getrandbits(128), None, self.name, self.attrs)
+        else:
+            return None
+        self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        sp = self._span
+        if sp is None:
+            return False
+        sp.end_ns = time.time_ns()
+        if exc_type is not None:
+            sp.error = True
+            sp.attrs["exception"] = repr(exc)
+        _current_span.reset(self._token)
+        span_exporter.export(sp)
+        return False
+
+def trace_root(name: str, **attrs: Any) -> span:
+    # Начало трассы (с учётом TRACE_SAMPLE_RATE); внутри уже активной трассы — обычный спан
+    return span(name, _root=True, **attrs)
+
 # ================== AIOGRAM CORE ==================
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Данные заказа/калькулятора: компактный объект вместо dict
+@dataclass(slots=True)
+class Order:
+    from_city: str = ""
+    from_display: str = ""
+    to_city: str = ""
+    date: str = ""
+    time: str = ""
+    pax: str = ""
+    phone: str = ""
+    comment: str = ""
+
+class _Conversation:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, now: float):
+        self.state: Optional[str] = None
+        self.data: Dict[str, Any] = {}
+        self.touched = now
+
+_KEEP_STATE: Any = object()
+
+class ConversationStorage(BaseStorage):
+    # In-memory FSM с TTL: диалоги в OrderedDict по времени последнего обращения,
+    # так что чистка брошенных — O(число просроченных). Все обращения видны в трассе.
+    def __init__(self, idle_ttl: float = FSM_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._items: "OrderedDict[StorageKey, _Conversation]" = OrderedDict()
+
+    @property
+    def size(self) -> int:
+        return len(self._items)
+
+    def _get(self, key: StorageKey, create: bool) -> Optional[_Conversation]:
+        now = time.monotonic()
+        conv = self._items.get(key)
+        if conv is None:
+            if not create:
+                return None
+            conv = _Conversation(now)
+            self._items[key] = conv
+        else:
+            conv.touched = now
+            self._items.move_to_end(key)
+        return conv
+
+    def _drop_if_empty(self, key: StorageKey, conv: _Conversation) -> None:
+        if conv.state is None and not conv.data:
+            self._items.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        with span("fsm.set_state"):
+            conv = self._get(key, create=state is not None)
+            if conv is None:
+                return
+            conv.state = state.state if isinstance(state, State) else state
+            self._drop_if_empty(key, conv)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        with span("fsm.get_state"):
+            conv = self._get(key, create=False)
+            return conv.state if conv is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        with span("fsm.set_data"):
+            conv = self._get(key, create=bool(data))
+            if conv is None:
+                return
+            conv.data = dict(data)
+            self._drop_if_empty(key, conv)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        with span("fsm.get_data"):
+            conv = self._get(key, create=False)
+            return dict(conv.data) if conv is not None else {}
+
+    async def get_order(self, key: StorageKey) -> Order:
+        with span("fsm.get_order"):
+            conv = self._get(key, create=False)
+            order = conv.data.get("order") if conv is not None else None
+            return order if isinstance(order, Order) else Order()
+
+    async def update_order(self, key: StorageKey, fields: Dict[str, str], state: Any = _KEEP_STATE) -> Order:
+        # Один read-modify-write вместо get_data + update_data + set_state
+        with span("fsm.update_order"):
+            conv = self._get(key, create=True)
+            order = conv.data.get("order")
+            if not isinstance(order, Order):
+                order = Order()
+                conv.data["order"] = order
+            for name, value in fields.items():
+                setattr(order, name, value)
+            if state is not _KEEP_STATE:
+                conv.state = state.state if isinstance(state, State) else state
+            return order
+
+    def sweep(self) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        removed = 0
+        while self._items:
+            key, conv = next(iter(self._items.items()))
+            if conv.touched > deadline:
+                break
+            del self._items[key]
+            removed += 1
+        return removed
+
+    async def close(self) -> None:
+        self._items.clear()
+
+async def get_order(state: FSMContext) -> Order:
+    return await fsm_storage.get_order(state.key)
+
+async def update_order(state: FSMContext, next_state: Any = _KEEP_STATE, **fields: str) -> Order:
+    return await fsm_storage.update_order(state.key, fields, next_state)
+
+async def fsm_sweeper() -> None:
+    while True:
+        await asyncio.sleep(FSM_SWEEP_INTERVAL)
+        removed = fsm_storage.sweep()
+        if removed:
+            logger.info("FSM sweep: %d idle conversation(s) removed, %d active", removed, fsm_storage.size)
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    # Каждый исходящий вызов Bot API — спан с именем метода
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Any:
+        with span(f"bot.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+class BotSessionStats:
+    # Загрузка пула и латентность запросов к Bot API
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.pool_waits = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        self.conn_created = 0
+        self.conn_reused = 0
+        self.latency: Dict[str, List[float]] = {}  # метод -> [count, total, max]
+
+    def observe(self, method: str, elapsed: float, ok: bool) -> None:
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        item = self.latency.get(method)
+        if item is None:
+            self.latency[method] = [1, elapsed, elapsed]
+        else:
+            item[0] += 1
+            item[1] += elapsed
+            if elapsed > item[2]:
+                item[2] = elapsed
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "utilization": round(self.in_flight / self.limit, 3) if self.limit else None,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "pool_waits": self.pool_waits,
+            "pool_wait_avg_ms": round(self.pool_wait_total / self.pool_waits * 1000, 2) if self.pool_waits else 0.0,
+            "pool_wait_max_ms": round(self.pool_wait_max * 1000, 2),
+            "conn_created": self.conn_created,
+            "conn_reused": self.conn_reused,
+            "latency_ms": {
+                name: {"count": c, "avg": round(total / c * 1000, 2), "max": round(mx * 1000, 2)}
+                for name, (c, total, mx) in self.latency.items()
+            },
+        }
+
+class TunedAiohttpSession(AiohttpSession):
+    # Настраиваемый пул (лимиты, keep-alive, DNS-кэш, таймауты по методам) со статистикой
+    def __init__(
+        self,
+        limit: int = BOT_POOL_LIMIT,
+        limit_per_host: int = BOT_POOL_LIMIT_PER_HOST,
+        keepalive: float = BOT_KEEPALIVE,
+        dns_ttl: int = BOT_DNS_TTL,
+        timeout: float = BOT_TIMEOUT,
+        method_timeouts: Optional[Dict[str, float]] = None,
+    ):
+        super().__init__(limit=limit, timeout=timeout)
+        self._connector_init.update(
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive,
+            ttl_dns_cache=dns_ttl,
+        )
+        self.method_timeouts = dict(BOT_METHOD_TIMEOUTS if method_timeouts is None else method_timeouts)
+        self.stats = BotSessionStats(limit)
+
+    def _trace_config(self) -> TraceConfig:
+        stats = self.stats
+        trace = TraceConfig()
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+
+        async def on_queued_end(session, ctx, params):
+            waited = time.perf_counter() - ctx.queued_at
+            stats.pool_waits += 1
+            stats.pool_wait_total += waited
+            stats.pool_wait_max = max(stats.pool_wait_max, waited)
+
+        async def on_create_end(session, ctx, params):
+            stats.conn_created += 1
+
+        async def on_reuse(session, ctx, params):
+            stats.conn_reused += 1
+
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    async def create_session(self) -> ClientSession:
+        if self._should_reset_connector:
+            await self.close()
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+                trace_configs=[self._trace_config()],
+            )
+            self._should_reset_connector = False
+        return self._session
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[TelegramType], timeout: Optional[int] = None) -> TelegramType:
+        name = method.__api_method__
+        if timeout is None:
+            timeout = self.method_timeouts.get(name)
+        stats = self.stats
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = await super().make_request(bot, method, timeout=timeout)
+            ok = True
+            return result
+        finally:
+            stats.in_flight -= 1
+            stats.observe(name, time.perf_counter() - started, ok)
+
+bot_session = TunedAiohttpSession()
+bot = Bot(token=BOT_TOKEN, session=bot_session)
+bot.session.middleware(TracingRequestMiddleware())
+fsm_storage = ConversationStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+# ================== ФОНОВЫЕ ЗАДАЧИ / ДРЕНАЖ ==================
+class InflightTracker:
+    # Счётчик апдейтов в обработке; после SIGTERM (draining) новые апдейты не принимаем
+    def __init__(self):
+        self.count = 0
+        self.draining = False
+
+    def enter(self) -> None:
+        self.count += 1
+
+    def exit(self) -> None:
+        self.count = max(0, self.count - 1)
+
+inflight = InflightTracker()
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    # Держим ссылку на задачу (иначе её может собрать GC) и дожидаемся её при остановке
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # ================== ЛЕЙБЛЫ КНОПОК ==================
 BTN_CALC = "🧮 Калькулятор стоимости"
@@ -434,21 +1084,190 @@ def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     a = math.sin(dphi/2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb/2) ** 2
     return R * (2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)))
 
-async def geocode_city(session: aiohttp.ClientSession, city: str) -> Optional[Dict[str, float]]:
+class CircuitBreaker:
+    # closed → (N ошибок подряд) → open → (cooldown) → half_open: одна пробная попытка
+    def __init__(self, name: str, max_failures: int, cooldown: float):
+        self.name = name
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        if self.state != "half_open":
+            return self.opened_at is None
+        self.opened_at = time.monotonic()  # пока идёт проба, остальные ждут следующего окна
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit %s closed", self.name)
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if self.opened_at is None:
+                logger.warning("Circuit %s opened after %d failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+
+nominatim_circuit = CircuitBreaker("nominatim", GEOCODE_CIRCUIT_FAILURES, GEOCODE_CIRCUIT_COOLDOWN)
+
+async def geocode_nominatim(session: aiohttp.ClientSession, city: str) -> Optional[Dict[str, float]]:
+    if not nominatim_circuit.allow():
+        return None
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": city, "format": "json", "limit": 1}
     headers = {"User-Agent": "TransferAir-KMV-Bot/1.0 (admin@example.com)"}
+    with span("geocode.nominatim", city=city) as sp:
+        try:
+            async with session.get(url, params=params, headers=headers, timeout=GEOCODE_HTTP_TIMEOUT) as r:
+                if sp is not None:
+                    sp.set("http.status", r.status)
+                if r.status == 429 or r.status >= 500:
+                    nominatim_circuit.record_failure()
+                    return None
+                if r.status != 200:
+                    return None
+                data = await r.json()
+                nominatim_circuit.record_success()
+                if not data:
+                    return None
+                return {"lat": float(data[0]["lat"]), "lon": float(data[0]["lon"])}
+        except Exception as e:
+            logger.warning("Geocode failed for %s: %s", city, e)
+            nominatim_circuit.record_failure()
+            if sp is not None:
+                sp.error = True
+            return None
+
+# ---- офлайн-геокодер (GeoNames) и цепочка бэкендов ----
+geo_index: Optional[GeoIndex] = None
+
+def load_geo_index() -> Optional[GeoIndex]:
+    if "geonames" not in GEOCODER_BACKENDS:
+        return None
+    if not os.path.exists(GEONAMES_INDEX):
+        if not GEONAMES_DUMP:
+            logger.warning("GeoNames index %s not found — offline geocoder disabled", GEONAMES_INDEX)
+            return None
+        n = build_index(GEONAMES_DUMP, GEONAMES_INDEX, GEONAMES_COUNTRIES, GEONAMES_BBOX)
+        logger.info("GeoNames index built from %s: %d names", GEONAMES_DUMP, n)
+    index = GeoIndex(GEONAMES_INDEX)
+    logger.info("GeoNames index loaded: %s (%d names)", GEONAMES_INDEX, len(index))
+    return index
+
+def geocode_geonames(city: str) -> Optional[Dict[str, float]]:
+    if geo_index is None:
+        return None
+    with span("geocode.geonames", city=city) as sp:
+        hit = geo_index.lookup(city)
+        if sp is not None:
+            sp.set("hit", hit is not None)
+    if hit is None:
+        return None
+    return {"lat": hit[0], "lon": hit[1]}
+
+async def geocode_city(session: aiohttp.ClientSession, city: str) -> Optional[Dict[str, float]]:
+    for backend in GEOCODER_BACKENDS:
+        if backend == "geonames":
+            result = geocode_geonames(city)
+        elif backend == "nominatim":
+            result = await geocode_nominatim(session, city)
+        else:
+            continue
+        if result is not None:
+            return result
+    return None
+
+# ---- кэш геокодера и общий бюджет на расчёт ----
+class GeoCache:
+    # LRU с TTL; неудачи (None) хранятся недолго, чтобы опечатка не ждала сеть повторно
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, Tuple[float, Optional[Dict[str, float]]]]" = OrderedDict()
+
+    def get(self, key: str) -> Tuple[bool, Optional[Dict[str, float]]]:
+        item = self._items.get(key)
+        if item is None:
+            return False, None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return False, None
+        self._items.move_to_end(key)
+        return True, value
+
+    def put(self, key: str, value: Optional[Dict[str, float]]) -> None:
+        ttl = GEOCODE_CACHE_TTL if value is not None else GEOCODE_NEGATIVE_TTL
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+geo_cache = GeoCache(GEOCODE_CACHE_SIZE)
+_geo_inflight: Dict[str, asyncio.Task] = {}
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    # Одна сессия на процесс: соединение с геокодером переиспользуется между расчётами
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+async def _geocode_and_cache(key: str, city: str) -> Optional[Dict[str, float]]:
     try:
-        async with session.get(url, params=params, headers=headers, timeout=20) as r:
-            if r.status != 200:
-                return None
-            data = await r.json()
-            if not data:
-                return None
-            return {"lat": float(data[0]["lat"]), "lon": float(data[0]["lon"])}
-    except Exception as e:
-        logger.warning(f"Geocode failed for {city}: {e}")
+        result = await geocode_city(get_http_session(), city)
+        geo_cache.put(key, result)
+        return result
+    finally:
+        _geo_inflight.pop(key, None)
+
+async def geocode_cached(city: str) -> Optional[Dict[str, float]]:
+    key = _norm_key(city)
+    found, value = geo_cache.get(key)
+    if found:
+        return value
+    task = _geo_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_geocode_and_cache(key, city))
+        _geo_inflight[key] = task
+    # shield: истёкший бюджет одного пользователя не отменяет общий запрос, его результат попадёт в кэш
+    return await asyncio.shield(task)
+
+class QuoteThrottled(Exception):
+    # Для расчёта нужен геокодер, а квота пользователя исчерпана
+    pass
+
+async def geocode_pair(from_city: str, to_city: str, budget: float = QUOTE_BUDGET) -> Optional[Tuple[Dict[str, float], Dict[str, float]]]:
+    # Квоту списываем, только если хотя бы одного города нет в кэше (повторный расчёт бесплатен)
+    cached = all(geo_cache.get(_norm_key(city))[0] for city in (from_city, to_city))
+    if not cached and not quote_allowed():
+        raise QuoteThrottled
+    with span("geocode.pair", budget=budget) as sp:
+        try:
+            a, b = await asyncio.wait_for(
+                asyncio.gather(geocode_cached(from_city), geocode_cached(to_city)),
+                timeout=budget,
+            )
+        except asyncio.TimeoutError:
+            logger.info("Quote budget %.1fs exceeded for %s → %s", budget, from_city, to_city)
+            if sp is not None:
+                sp.set("timeout", True)
+            return None
+    if not a or not b:
         return None
+    return a, b
 
 def prices_text_total_only(econom: int, camry: int, minivan: int) -> str:
     return (
@@ -472,35 +1291,655 @@ async def compute_prices_for_order(from_city: str, to_city: str) -> Optional[Tup
         e, c, m = FIXED_PRICES[to_key]
         return e, c, m, "fixed"
 
-    async with aiohttp.ClientSession() as session:
-        a = await geocode_city(session, from_city)
-        b = await geocode_city(session, to_city)
-    if not a or not b:
+    try:
+        pair = await geocode_pair(from_city, to_city)
+    except QuoteThrottled:
+        return None
+    if not pair:
         return None
+    a, b = pair
     dist = haversine_km(a["lat"], a["lon"], b["lat"], b["lon"])
     e, c, m = per_km_prices(dist)
     return e, c, m, "distance"
 
 PHONE_RE = re.compile(r"^\+?\d[\d\-\s]{8,}$")
 
+# ================== АНТИФЛУД (RATE LIMIT) ==================
+THROTTLE_TEXT = "⏳ Слишком много запросов. Пожалуйста, подождите немного и попробуйте снова."
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, burst: int, now: float):
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, rate: float, burst: int, now: float) -> bool:
+        self.tokens = min(float(burst), self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+class _UserLimits:
+    __slots__ = ("cheap", "quote", "warned")
+
+    def __init__(self, now: float):
+        self.cheap = TokenBucket(RATE_CHEAP_BURST, now)
+        self.quote = TokenBucket(RATE_QUOTE_BURST, now)
+        self.warned = False
+
+# Пользователь текущего апдейта для квоты расчётов (None — админ или не через middleware)
+rate_user: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("rate_user", default=None)
+
+# Токен-бакеты на пользователя в ограниченном LRU: память не растёт бесконечно
+class RateLimitMiddleware(BaseMiddleware):
+
+    def __init__(self, max_users: int = RATE_MAX_USERS):
+        self.max_users = max_users
+        self.users: "OrderedDict[int, _UserLimits]" = OrderedDict()
+        self.throttled = 0
+
+    def _limits(self, user_id: int, now: float) -> _UserLimits:
+        limits = self.users.get(user_id)
+        if limits is None:
+            limits = _UserLimits(now)
+            self.users[user_id] = limits
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        return limits
+
+    # (пропустить?, предупредить?) — предупреждаем один раз за серию флуда
+    def allow(self, user_id: int) -> Tuple[bool, bool]:
+        now = time.monotonic()
+        limits = self._limits(user_id, now)
+        if limits.cheap.take(RATE_CHEAP_PER_SEC, RATE_CHEAP_BURST, now):
+            limits.warned = False
+            return True, False
+        self.throttled += 1
+        warn = not limits.warned
+        limits.warned = True
+        return False, warn
+
+    def take_quote(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if self._limits(user_id, now).quote.take(RATE_QUOTE_PER_MIN / 60.0, RATE_QUOTE_BURST, now):
+            return True
+        self.throttled += 1
+        return False
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_CHAT_ID:
+            return await handler(event, data)
+
+        allowed, warn = self.allow(user.id)
+        if allowed:
+            token = rate_user.set(user.id)
+            try:
+                return await handler(event, data)
+            finally:
+                rate_user.reset(token)
+
+        # Ответ уходит в теле ответа вебхука (см. WEBHOOK_REPLY)
+        if isinstance(event, CallbackQuery):
+            # На callback отвечаем всегда, иначе у клиента крутятся «часики»
+            return event.answer(THROTTLE_TEXT if warn else None)
+        if warn and isinstance(event, Message):
+            return event.answer(THROTTLE_TEXT)
+        return None
+
+rate_limiter = RateLimitMiddleware()
+dp.message.outer_middleware(rate_limiter)
+dp.callback_query.outer_middleware(rate_limiter)
+
+def quote_allowed() -> bool:
+    # Вызывается из geocode_pair при промахе кэша: фиксированные цены, меню, команды и кэш квоту не тратят
+    user_id = rate_user.get()
+    return user_id is None or rate_limiter.take_quote(user_id)
+
+# Имя хендлера в контексте логов и спан хендлера (inner middleware видит выбранный хендлер)
+class HandlerContextMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", None)
+        token = log_handler.set(name)
+        try:
+            with span(f"handler.{name}"):
+                return await handler(event, data)
+        finally:
+            log_handler.reset(token)
+
+# Для callback_query то же делает CallbackRouter.dispatch — уже для настоящего хендлера
+dp.message.middleware(HandlerContextMiddleware())
+
+# ================== CALLBACK-РОУТЕР ==================
+# callback_data разбирается один раз: префикс до «:» -> хендлер через dict,
+# остаток -> типизированный payload. Вместо перебора F.data.startswith(...) по списку.
+CallbackHandler = Callable[[CallbackQuery, FSMContext, Any], Awaitable[Any]]
+
+class YearMonth(NamedTuple):
+    year: int
+    month: int
+
+def parse_int(rest: str) -> int:
+    return int(rest)
+
+def parse_year_month(rest: str) -> YearMonth:
+    y, m = rest.split(":")
+    return YearMonth(int(y), int(m))
+
+def parse_pick_date(rest: str) -> date:
+    if rest == "today":
+        return date.today()
+    if rest == "tomorrow":
+        return date.today() + timedelta(days=1)
+    y, m, d = rest.split(":")
+    return date(int(y), int(m), int(d))
+
+def parse_hour(rest: str) -> str:
+    return f"{int(rest):02d}"
+
+def parse_time(rest: str) -> str:
+    hour, minute = rest.split(":")
+    return f"{int(hour):02d}:{int(minute):02d}"
+
+def parse_pax(rest: str) -> str:
+    return "7 и более" if rest == "7+" else str(int(rest))
+
+class CallbackRouter:
+    def __init__(self):
+        self._routes: Dict[str, Tuple[CallbackHandler, Optional[Callable[[str], Any]]]] = {}
+
+    def route(self, *prefixes: str, parse: Optional[Callable[[str], Any]] = None):
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            for prefix in prefixes:
+                if prefix in self._routes:
+                    raise ValueError(f"callback prefix {prefix!r} is already routed")
+                self._routes[prefix] = (handler, parse)
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Tuple[CallbackHandler, Any]]:
+        prefix, _, rest = data.partition(":")
+        entry = self._routes.get(prefix)
+        if entry is None:
+            return None
+        handler, parse = entry
+        return handler, (parse(rest) if parse is not None else prefix)
+
+    async def dispatch(self, cb: CallbackQuery, state: FSMContext) -> Any:
+        try:
+            resolved = self.resolve(cb.data or "")
+        except (ValueError, TypeError):
+            logger.info("Malformed callback_data: %r", cb.data)
+            resolved = None
+        if resolved is None:
+            # noop-кнопки и устаревшие клавиатуры: просто гасим «часики»
+            return cb.answer()
+        handler, payload = resolved
+        token = log_handler.set(handler.__name__)
+        try:
+            with span(f"handler.{handler.__name__}"):
+                return await handler(cb, state, payload)
+        finally:
+            log_handler.reset(token)
+
+callback_router = CallbackRouter()
+
+@dp.callback_query()
+async def callback_dispatch(cb: CallbackQuery, state: FSMContext):
+    return await callback_router.dispatch(cb, state)
+
+# ================== ПОЛЬЗОВАТЕЛИ И РАССЫЛКА ==================
+class UserRegistry:
+    # Множество id в памяти, на диске — append-only массив int64 (8 байт на запись).
+    # Удаление — «надгробие» ~id (отрицательное число); файл сжимается при загрузке и по итогам рассылки
+    def __init__(self, path: str):
+        self.path = path
+        self._ids: set = set()
+        self._file = None
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._ids
+
+    @property
+    def size(self) -> int:
+        return len(self._ids)
+
+    def load(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ids = array("q")
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            ids.frombytes(raw[:len(raw) - len(raw) % ids.itemsize])
+        self._ids = set()
+        for user_id in ids:
+            if user_id >= 0:
+                self._ids.add(user_id)
+            else:
+                self._ids.discard(~user_id)
+        if len(ids) != len(self._ids):
+            self.compact()
+        else:
+            self._file = open(self.path, "ab", buffering=0)
+        logger.info("User registry loaded: %d users", len(self._ids))
+
+    def add(self, user_id: int) -> bool:
+        if user_id in self._ids:
+            return False
+        self._ids.add(user_id)
+        if self._file is not None:
+            self._file.write(array("q", [user_id]).tobytes())
+        return True
+
+    def discard(self, user_id: int) -> None:
+        if user_id not in self._ids:
+            return
+        self._ids.discard(user_id)
+        if self._file is not None:
+            self._file.write(array("q", [~user_id]).tobytes())
+
+    def snapshot(self) -> List[int]:
+        return sorted(self._ids)
+
+    def compact(self) -> None:
+        # Переписываем файл без удалённых (заблокировавших бота) пользователей
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(array("q", sorted(self._ids)).tobytes())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, "ab", buffering=0)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+user_registry = UserRegistry(os.path.join(DATA_DIR, "users.bin"))
+
+@dataclass
+class BroadcastJob:
+    text: str
+    total: int
+    position: int = 0
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    started_at: float = 0.0
+    finished: bool = False
+    cancelled: bool = False
+
+class Broadcaster:
+    # Рассылка пачками с темпом BROADCAST_RATE; после каждой пачки — чекпоинт на диск,
+    # поэтому после рестарта продолжаем с места остановки (повторно уйдёт максимум одна пачка)
+    def __init__(self, data_dir: str, rate: float = BROADCAST_RATE, chunk: int = BROADCAST_CHUNK):
+        self.state_path = os.path.join(data_dir, "broadcast.json")
+        self.ids_path = os.path.join(data_dir, "broadcast.ids")
+        self.rate = rate
+        self.chunk = chunk
+        self.job: Optional[BroadcastJob] = None
+        self.recipients = array("q")
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _save(self) -> None:
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(asdict(self.job)))
+        os.replace(tmp, self.state_path)
+
+    def start(self, text: str, recipients: List[int]) -> BroadcastJob:
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        self.recipients = array("q", recipients)
+        with open(self.ids_path, "wb") as f:
+            f.write(self.recipients.tobytes())
+        self.job = BroadcastJob(text=text, total=len(recipients), started_at=time.time())
+        self._save()
+        self._launch()
+        return self.job
+
+    def resume(self) -> bool:
+        if not os.path.exists(self.state_path):
+            return False
+        with open(self.state_path, "rb") as f:
+            self.job = BroadcastJob(**orjson.loads(f.read()))
+        if self.job.finished or self.job.cancelled:
+            return False
+        self.recipients = array("q")
+        with open(self.ids_path, "rb") as f:
+            self.recipients.frombytes(f.read())
+        logger.info("Resuming broadcast at %d/%d", self.job.position, self.job.total)
+        self._launch()
+        return True
+
+    def cancel(self) -> None:
+        if self.job is not None and self.running:
+            self.job.cancelled = True
+            self._save()
+            self._task.cancel()
+
+    def _launch(self) -> None:
+        self._task = asyncio.create_task(self._run())
+        _service_tasks.append(self._task)
+
+    async def _send_one(self, user_id: int, text: str, delay: float) -> str:
+        await asyncio.sleep(delay)
+        for _ in range(3):
+            try:
+                await bot.send_message(user_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                return "blocked" if "chat not found" in str(e).lower() else "failed"
+            except Exception as e:
+                logger.warning("Broadcast to %s failed: %s", user_id, e)
+                return "failed"
+        return "failed"
+
+    async def _run(self) -> None:
+        job = self.job
+        loop = asyncio.get_running_loop()
+        try:
+            while job.position < job.total:
+                chunk = self.recipients[job.position:job.position + self.chunk]
+                started = loop.time()
+                results = await asyncio.gather(*(
+                    self._send_one(uid, job.text, i / self.rate) for i, uid in enumerate(chunk)
+                ))
+                for uid, outcome in zip(chunk, results):
+                    if outcome == "sent":
+                        job.sent += 1
+                    elif outcome == "blocked":
+                        job.blocked += 1
+                        user_registry.discard(uid)  # надгробие в файле: после рестарта не вернётся
+                    else:
+                        job.failed += 1
+                job.position += len(chunk)
+                self._save()
+                pause = len(chunk) / self.rate - (loop.time() - started)
+                if pause > 0:
+                    await asyncio.sleep(pause)
+            job.finished = True
+            self._save()
+            if job.blocked:
+                user_registry.compact()
+            await bot.send_message(ADMIN_CHAT_ID, "📣 Рассылка завершена.\n\n" + self.report())
+        except asyncio.CancelledError:
+            self._save()
+            raise
+
+    def report(self) -> str:
+        job = self.job
+        if job is None:
+            return "Рассылок ещё не было."
+        minutes = (time.time() - job.started_at) / 60
+        return (
+            f"Обработано: {job.position}/{job.total}\n"
+            f"Доставлено: {job.sent}\n"
+            f"Заблокировали бота: {job.blocked}\n"
+            f"Ошибки: {job.failed}\n"
+            f"Время: {minutes:.1f} мин"
+        )
+
+broadcaster = Broadcaster(DATA_DIR)
+
+def is_admin(message: Message) -> bool:
+    # Только сам админ, как в антифлуде: ADMIN_CHAT_ID может быть группой диспетчеров
+    return message.from_user is not None and message.from_user.id == ADMIN_CHAT_ID
+
+# ================== НАПОМИНАНИЯ О ПОДАЧЕ ==================
+@dataclass(slots=True)
+class Reminder:
+    id: str
+    at: float       # когда отправить (unix time)
+    pickup: float   # время подачи: после него напоминание уже не нужно
+    chat_id: int
+    text: str
+    attempt: int = 0
+
+# Повтор после сетевой/серверной ошибки: 30 с, 1 мин, 2 мин … но не дольше 10 мин
+REMINDER_RETRY_BASE = 30.0
+REMINDER_RETRY_MAX = 600.0
+
+class ReminderScheduler:
+    # Мин-куча (at, seq, id): добавление и выборка — O(log n). Планировщик спит до ближайшего
+    # срока, а пустой — до первого add; отдельного пробуждения на каждый таймер нет.
+    # Журнал на диске append-only: строки add/done; при загрузке переигрываем и сжимаем.
+    # Наступившие напоминания встают в очередь _ready и уходят с темпом rate, не больше concurrency сразу.
+    def __init__(self, path: str, max_sleep: float = 3600,
+                 rate: float = REMINDER_RATE, concurrency: int = REMINDER_CONCURRENCY):
+        self.path = path
+        self.max_sleep = max_sleep  # перепроверка на случай перевода системных часов
+        self.rate = rate
+        self.concurrency = concurrency
+        self._ready: Deque[Reminder] = deque()
+        self._ready_event = asyncio.Event()
+        self._heap: List[Tuple[float, int, str]] = []
+        self._items: Dict[str, Reminder] = {}
+        self._seq = 0
+        self._journal = None
+        self._journal_lines = 0
+        self._wakeup = asyncio.Event()
+
+    @property
+    def size(self) -> int:
+        return len(self._items)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self._journal is not None:
+            self._journal.write(orjson.dumps(record) + b"\n")
+            self._journal_lines += 1
+
+    def _push(self, rem: Reminder) -> None:
+        self._items[rem.id] = rem
+        self._seq += 1
+        heapq.heappush(self._heap, (rem.at, self._seq, rem.id))
+
+    def load(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        items: Dict[str, Reminder] = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue  # недописанная строка после аварийной остановки
+                    if record.get("op") == "add":
+                        items[record["id"]] = Reminder(**record["r"])
+                    else:
+                        items.pop(record.get("id"), None)
+        now = time.time()
+        stale = [k for k, rem in items.items() if rem.pickup <= now]
+        for key in stale:
+            del items[key]
+        for rem in items.values():
+            self._push(rem)
+        self._compact()
+        logger.info("Reminders loaded: %d pending, %d stale dropped", len(items), len(stale))
+
+    def _compact(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for rem in self._items.values():
+                f.write(orjson.dumps({"op": "add", "id": rem.id, "r": asdict(rem)}) + b"\n")
+        if self._journal is not None:
+            self._journal.close()
+        os.replace(tmp, self.path)
+        self._journal = open(self.path, "ab", buffering=0)
+        self._journal_lines = len(self._items)
+
+    def add(self, rem: Reminder) -> None:
+        self._write({"op": "add", "id": rem.id, "r": asdict(rem)})
+        earliest = self._heap[0][0] if self._heap else None
+        self._push(rem)
+        if earliest is None or rem.at < earliest:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> List[Reminder]:
+        # Из _items напоминание уходит только при отправке: до неё оно в журнале и в сжатии
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            rem = self._items.get(key)
+            if rem is not None:
+                due.append(rem)
+        return due
+
+    async def _pump(self) -> None:
+        limit = asyncio.Semaphore(self.concurrency)
+        while True:
+            while not self._ready:
+                self._ready_event.clear()
+                await self._ready_event.wait()
+            await limit.acquire()
+            rem = self._ready.popleft()
+            self._items.pop(rem.id, None)
+            # done пишем до отправки: после рестарта напоминание не повторится
+            self._write({"op": "done", "id": rem.id})
+            if rem.pickup <= time.time():
+                limit.release()
+                logger.warning("Reminder %s to %s dropped: pickup time reached", rem.id, rem.chat_id)
+                continue
+            spawn(self._send(rem)).add_done_callback(lambda _: limit.release())
+            await asyncio.sleep(1 / self.rate)
+
+    async def run(self) -> None:
+        pump = asyncio.create_task(self._pump())
+        try:
+            await self._schedule()
+        finally:
+            pump.cancel()
+
+    async def _schedule(self) -> None:
+        while True:
+            now = time.time()
+            due = self._pop_due(now)
+            if due:
+                self._ready.extend(due)
+                self._ready_event.set()
+            if self._journal_lines > 2 * len(self._items) + 1000:
+                self._compact()
+            timeout = min(self._heap[0][0] - now, self.max_sleep) if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _retry(self, rem: Reminder, delay: float) -> None:
+        at = time.time() + delay
+        if at >= rem.pickup:
+            logger.warning("Reminder %s to %s dropped: pickup time reached", rem.id, rem.chat_id)
+            return
+        self.add(Reminder(rem.id, at, rem.pickup, rem.chat_id, rem.text, rem.attempt + 1))
+
+    async def _send(self, rem: Reminder) -> None:
+        # done уже в журнале: всё, что не доставлено по временной причине, ставим в журнал заново
+        try:
+            await bot.send_message(rem.chat_id, rem.text)
+        except TelegramRetryAfter as e:
+            self._retry(rem, e.retry_after)
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+            logger.warning("Reminder %s to %s failed (attempt %d): %s", rem.id, rem.chat_id, rem.attempt + 1, e)
+            self._retry(rem, min(REMINDER_RETRY_BASE * 2 ** rem.attempt, REMINDER_RETRY_MAX))
+        except asyncio.CancelledError:
+            # Остановка не дождалась отправки — отправим после рестарта
+            self._retry(rem, 0)
+            raise
+        except Exception as e:
+            logger.warning("Reminder %s to %s failed: %s", rem.id, rem.chat_id, e)
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+reminders = ReminderScheduler(os.path.join(DATA_DIR, "reminders.log"))
+
+def format_lead(minutes: int) -> str:
+    if minutes % 1440 == 0:
+        return f"{minutes // 1440} сут."
+    if minutes % 60 == 0:
+        return f"{minutes // 60} ч"
+    return f"{minutes} мин"
+
+def pickup_timestamp(order: Order) -> Optional[float]:
+    # Дата и время из календаря («31.12.2025», «09:30»); ручной ввод может не разобраться
+    try:
+        dt = datetime.strptime(f"{order.date} {order.time}", "%d.%m.%Y %H:%M")
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=PICKUP_TZ).timestamp()
+
+def schedule_order_reminders(order: Order, chat_id: int) -> int:
+    pickup = pickup_timestamp(order)
+    now = time.time()
+    if pickup is None or pickup <= now:
+        return 0
+    route = f"{order.from_display or order.from_city} → {order.to_city}"
+    order_id = f"{chat_id}-{int(now * 1000)}"
+    planned = [
+        ("c", lead, chat_id,
+         f"⏰ Напоминание: подача автомобиля {order.date} в {order.time}.\n"
+         f"Маршрут: {route}\n\nЕсли планы изменились — позвоните диспетчеру: {DISPATCHER_PHONE}")
+        for lead in REMINDER_LEADS_CUSTOMER
+    ]
+    if ADMIN_CHAT_ID:
+        planned += [
+            ("d", lead, ADMIN_CHAT_ID,
+             f"⏰ Через {format_lead(lead)} подача: {order.date} {order.time}\n"
+             f"{route}\nПассажиров: {order.pax}\nТелефон: {order.phone}")
+            for lead in REMINDER_LEADS_DISPATCHER
+        ]
+    count = 0
+    for who, lead, target, text in planned:
+        at = pickup - lead * 60
+        if at <= now:
+            continue  # до подачи уже меньше этого срока
+        reminders.add(Reminder(f"{order_id}:{who}{lead}", at, pickup, target, text))
+        count += 1
+    return count
+
 # ================== ГЛОБАЛЬНЫЙ РОУТЕР МЕНЮ ==================
 @dp.message(F.text.in_(MENU_BUTTONS))
 async def menu_router(message: Message, state: FSMContext):
+    user_registry.add(message.from_user.id)
     await state.clear()
     text = message.text
 
     if text == BTN_CALC:
         await state.set_state(CalcStates.from_city)
         await message.answer("Введите *город отправления* (или выберите ниже):", parse_mode="Markdown")
-        await message.answer("Быстрый выбор:", reply_markup=from_suggestions_kb())
-        return
+        return message.answer("Быстрый выбор:", reply_markup=from_suggestions_kb())
 
     if text == BTN_ORDER:
-        await state.set_state(OrderForm.from_city)
-        await state.update_data(order={})
+        await update_order(state, OrderForm.from_city)
         await message.answer("Введите *город отправления* (или выберите ниже):", parse_mode="Markdown")
-        await message.answer("Быстрый выбор:", reply_markup=from_suggestions_kb())
-        return
+        return message.answer("Быстрый выбор:", reply_markup=from_suggestions_kb())
 
     if text == BTN_DISPATCHER:
         info = (
@@ -508,24 +1947,46 @@ async def menu_router(message: Message, state: FSMContext):
             "Нажмите кнопку ниже, чтобы написать диспетчеру в Telegram\n"
             "или получить номер телефона для звонка."
         )
-        await message.answer(info, parse_mode="Markdown", reply_markup=dispatcher_inline_kb())
-        return
+        return message.answer(info, parse_mode="Markdown", reply_markup=dispatcher_inline_kb())
 
     if text == BTN_INFO:
-        await message.answer(
+        return message.answer(
             "🚕 TransferAir междугороднее такси (Трансфер) из Минеральных Вод.\n\n"
             "🤖 Вы можете заказать трансфер через бота.\n\n"
             "📞 Позвонить нам: +79340241414\n\n"
             "🌐 Посетить наш сайт: https://transferkmw.ru/",
         )
-        return
 
 # ================== START ==================
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     # Без приветствия и без кнопки «Старт». Сразу показываем главное меню.
+    user_registry.add(message.from_user.id)
     await state.clear()
-    await message.answer("Выберите действие:", reply_markup=main_menu_kb())
+    return message.answer("Выберите действие:", reply_markup=main_menu_kb())
+
+# ---- РАССЫЛКА (только админ) ----
+@dp.message(Command("broadcast"), is_admin)
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if broadcaster.running:
+        return message.answer("Рассылка уже идёт.\n\n" + broadcaster.report())
+    text = (command.args or "").strip()
+    if not text:
+        return message.answer("Использование: /broadcast текст сообщения")
+    job = broadcaster.start(text, user_registry.snapshot())
+    return message.answer(f"📣 Рассылка запущена: {job.total} получателей.")
+
+@dp.message(Command("broadcast_status"), is_admin)
+async def cmd_broadcast_status(message: Message):
+    state = "идёт" if broadcaster.running else "не идёт"
+    return message.answer(f"Рассылка {state}. Пользователей в реестре: {user_registry.size}\n\n" + broadcaster.report())
+
+@dp.message(Command("broadcast_cancel"), is_admin)
+async def cmd_broadcast_cancel(message: Message):
+    if not broadcaster.running:
+        return message.answer("Рассылка не идёт.")
+    broadcaster.cancel()
+    return message.answer("Рассылка остановлена.\n\n" + broadcaster.report())
 
 # ---- ДИСПЕТЧЕР ----
 @dp.message(F.text == BTN_DISPATCHER)
@@ -535,53 +1996,41 @@ async def on_dispatcher(message: Message):
         "Нажмите кнопку ниже, чтобы написать диспетчеру в Telegram\n"
         "или получить номер телефона для звонка."
     )
-    await message.answer(text, parse_mode="Markdown", reply_markup=dispatcher_inline_kb())
+    return message.answer(text, parse_mode="Markdown", reply_markup=dispatcher_inline_kb())
 
-@dp.callback_query(F.data == "dispatcher_phone")
-async def dispatcher_phone_cb(cb: CallbackQuery):
+@callback_router.route("dispatcher_phone")
+async def dispatcher_phone_cb(cb: CallbackQuery, state: FSMContext, _: str):
     # Просто текст с номером — Telegram делает его кликабельным
     await cb.message.answer(f"📞 Телефон диспетчера: {DISPATCHER_PHONE}\nНажмите на номер, чтобы позвонить.")
-    await cb.answer("Номер отправлен")
+    return cb.answer("Номер отправлен")
 
 # ================== ПОДХВАТ FROM/TO ПОДСКАЗОК ==================
-@dp.callback_query(F.data.startswith("fp:"))
-async def pick_from(cb: CallbackQuery, state: FSMContext):
-    key = cb.data.split(":", 1)[1]  # mv | mrv
+@callback_router.route("fp", parse=str)
+async def pick_from(cb: CallbackQuery, state: FSMContext, key: str):
+    # key: mv | mrv
     canonical, display = FROM_CHOICES.get(key, ("Минеральные Воды", "Минеральные Воды"))
 
     current = await state.get_state()
     if current and current.endswith("from_city"):
-        if current.startswith("CalcStates"):
-            await state.update_data(from_city=canonical, from_display=display)
-            await state.set_state(CalcStates.to_city)
-            await cb.message.edit_text(
-                f"Отправление: *{display}* ✅\nВведите *город прибытия* (или выберите ниже):",
-                parse_mode="Markdown"
-            )
-            await cb.message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
-        else:
-            order = {"from_city": canonical, "from_display": display}
-            await state.update_data(order=order)
-            await state.set_state(OrderForm.to_city)
-            await cb.message.edit_text(
-                f"Отправление: *{display}* ✅\nВведите *город прибытия* (или выберите ниже):",
-                parse_mode="Markdown"
-            )
-            await cb.message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
-    await cb.answer()
+        next_state = CalcStates.to_city if current.startswith("CalcStates") else OrderForm.to_city
+        await update_order(state, next_state, from_city=canonical, from_display=display)
+        await cb.message.edit_text(
+            f"Отправление: *{display}* ✅\nВведите *город прибытия* (или выберите ниже):",
+            parse_mode="Markdown"
+        )
+        await cb.message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
+    return cb.answer()
 
-@dp.callback_query(F.data.startswith("dest_page:"))
-async def dest_page(cb: CallbackQuery):
-    page = int(cb.data.split(":", 1)[1])
+@callback_router.route("dest_page", parse=parse_int)
+async def dest_page(cb: CallbackQuery, state: FSMContext, page: int):
     try:
         await cb.message.edit_reply_markup(reply_markup=dest_suggestions_kb(page))
     except Exception:
         await cb.message.answer("Ещё варианты:", reply_markup=dest_suggestions_kb(page))
-    await cb.answer()
+    return cb.answer()
 
-@dp.callback_query(F.data.startswith("dest_pick:"))
-async def dest_pick(cb: CallbackQuery, state: FSMContext):
-    key = cb.data.split(":", 1)[1]
+@callback_router.route("dest_pick", parse=str)
+async def dest_pick(cb: CallbackQuery, state: FSMContext, key: str):
     display_dest = next((d for d, k in DEST_OPTIONS if k == key), key.title())
 
     try:
@@ -589,12 +2038,12 @@ async def dest_pick(cb: CallbackQuery, state: FSMContext):
         if current and current.endswith("to_city"):
             # ---- КАЛЬКУЛЯТОР ----
             if current.startswith("CalcStates"):
-                data = await state.get_data()
-                from_city = data.get("from_city") or "Минеральные Воды"
-                from_display = data.get("from_display") or "Минеральные Воды"
-                await state.clear()
+                order = await get_order(state)
+                from_city = order.from_city or "Минеральные Воды"
+                from_display = order.from_display or "Минеральные Воды"
 
                 if key in FIXED_PRICES and _norm_key(from_city) == "минеральные воды":
+                    await state.clear()
                     e, c, m = FIXED_PRICES[key]
                     txt = (
                         "⚠️ *Стоимость предварительная, окончательная цена оговаривается с диспетчером!*\n\n"
@@ -604,16 +2053,18 @@ async def dest_pick(cb: CallbackQuery, state: FSMContext):
                     )
                     await cb.message.edit_text(txt, parse_mode="Markdown")
                     await bot.send_message(cb.message.chat.id, "Вы в главном меню:", reply_markup=main_menu_kb())
-                    await cb.answer()
-                    return
+                    return cb.answer()
 
-                async with aiohttp.ClientSession() as session:
-                    a = await geocode_city(session, from_city)
-                    b = await geocode_city(session, display_dest)
-                if not a or not b:
+                try:
+                    pair = await geocode_pair(from_city, display_dest)
+                except QuoteThrottled:
+                    # Состояние не сбрасываем: можно выбрать снова чуть позже
+                    return cb.answer(THROTTLE_TEXT, show_alert=True)
+                await state.clear()
+                if not pair:
                     await cb.message.answer("❌ Не удалось определить города. Попробуйте ещё раз.")
-                    await cb.answer()
-                    return
+                    return cb.answer()
+                a, b = pair
                 dist = haversine_km(a["lat"], a["lon"], b["lat"], b["lon"])
                 p_e, p_c, p_m = per_km_prices(dist)
                 txt = (
@@ -624,16 +2075,11 @@ async def dest_pick(cb: CallbackQuery, state: FSMContext):
                 )
                 await cb.message.edit_text(txt, parse_mode="Markdown")
                 await bot.send_message(cb.message.chat.id, "Вы в главном меню:", reply_markup=main_menu_kb())
-                await cb.answer()
-                return
+                return cb.answer()
 
             # ---- ЗАКАЗ ----
             else:
-                data = await state.get_data()
-                order = data.get("order", {})
-                order["to_city"] = display_dest
-                await state.update_data(order=order)
-                await state.set_state(OrderForm.date)
+                await update_order(state, OrderForm.date, to_city=display_dest)
 
                 today = date.today()
                 await cb.message.edit_text(
@@ -643,113 +2089,86 @@ async def dest_pick(cb: CallbackQuery, state: FSMContext):
                 await cb.message.answer("Календарь:", reply_markup=date_calendar_kb(today.year, today.month))
         await cb.answer()
     except Exception as e:
-        logger.exception(f"dest_pick handler failed: {e}")
+        logger.exception("dest_pick handler failed: %s", e)
         await cb.message.answer("Произошла ошибка при расчёте. Попробуйте ещё раз.")
         await cb.answer()
 
 # ---- КАЛЕНДАРЬ: обработчики ----
-@dp.callback_query(F.data == "calcancel")
-async def cal_cancel(cb: CallbackQuery, state: FSMContext):
+@callback_router.route("calcancel")
+async def cal_cancel(cb: CallbackQuery, state: FSMContext, _: str):
     await cb.message.delete()
     await cb.answer("Выбор даты отменён")
     await bot.send_message(cb.message.chat.id, "Выберите *дату подачи*:", parse_mode="Markdown")
     await state.set_state(OrderForm.date)
 
-@dp.callback_query(F.data.startswith("calnav:"))
-async def cal_nav(cb: CallbackQuery):
-    _, y, m = cb.data.split(":")
-    y, m = int(y), int(m)
+@callback_router.route("calnav", parse=parse_year_month)
+async def cal_nav(cb: CallbackQuery, state: FSMContext, ym: YearMonth):
+    y, m = ym
     try:
         await cb.message.edit_reply_markup(reply_markup=date_calendar_kb(y, m))
     except Exception:
         await cb.message.answer("Календарь:", reply_markup=date_calendar_kb(y, m))
-    await cb.answer()
+    return cb.answer()
 
-@dp.callback_query(F.data.startswith("calpick:"))
-async def cal_pick(cb: CallbackQuery, state: FSMContext):
-    parts = cb.data.split(":")
-    if parts[1] in ("today", "tomorrow"):
-        d = date.today() if parts[1] == "today" else date.today() + timedelta(days=1)
-    else:
-        y, m, d_ = map(int, parts[1:4])
-        d = date(y, m, d_)
-    data = await state.get_data()
-    order = data.get("order", {})
-    order["date"] = d.strftime("%d.%m.%Y")
-    await state.update_data(order=order)
-
-    await cb.message.edit_text(f"Дата подачи: *{order['date']}* ✅", parse_mode="Markdown")
+@callback_router.route("calpick", parse=parse_pick_date)
+async def cal_pick(cb: CallbackQuery, state: FSMContext, d: date):
+    order = await update_order(state, OrderForm.time, date=d.strftime("%d.%m.%Y"))
+
+    await cb.message.edit_text(f"Дата подачи: *{order.date}* ✅", parse_mode="Markdown")
     await bot.send_message(cb.message.chat.id, "Выберите *время подачи* — сначала выберите час:", parse_mode="Markdown", reply_markup=time_hours_kb())
-    await state.set_state(OrderForm.time)
-    await cb.answer("Дата выбрана")
+    return cb.answer("Дата выбрана")
 
 # ---- ВРЕМЯ: обработчики ----
-@dp.callback_query(F.data == "timecancel")
-async def time_cancel(cb: CallbackQuery, state: FSMContext):
+@callback_router.route("timecancel")
+async def time_cancel(cb: CallbackQuery, state: FSMContext, _: str):
     await cb.message.delete()
     await cb.answer("Выбор времени отменён")
     await bot.send_message(cb.message.chat.id, "Выберите *время подачи* (сначала час):", parse_mode="Markdown", reply_markup=time_hours_kb())
     await state.set_state(OrderForm.time)
 
-@dp.callback_query(F.data == "timeback")
-async def time_back(cb: CallbackQuery, state: FSMContext):
+@callback_router.route("timeback")
+async def time_back(cb: CallbackQuery, state: FSMContext, _: str):
     try:
         await cb.message.edit_text("Выберите *время подачи* — сначала выберите час:", parse_mode="Markdown")
     except Exception:
         pass
     await cb.message.answer("Часы:", reply_markup=time_hours_kb())
-    await cb.answer()
+    return cb.answer()
 
-@dp.callback_query(F.data.startswith("timeh:"))
-async def time_pick_hour(cb: CallbackQuery, state: FSMContext):
-    hour = cb.data.split(":", 1)[1]
+@callback_router.route("timeh", parse=parse_hour)
+async def time_pick_hour(cb: CallbackQuery, state: FSMContext, hour: str):
     try:
         await cb.message.edit_text(f"Час: *{hour}* — теперь выберите минуты:", parse_mode="Markdown")
     except Exception:
         pass
     await cb.message.answer("Минуты:", reply_markup=time_minutes_kb(hour))
-    await cb.answer()
-
-@dp.callback_query(F.data.startswith("timem:"))
-async def time_pick_minutes(cb: CallbackQuery, state: FSMContext):
-    _, hour, minute = cb.data.split(":")
-    tm = f"{hour}:{minute}"
-    data = await state.get_data()
-    order = data.get("order", {})
-    order["time"] = tm
-    await state.update_data(order=order)
-
-    await cb.message.edit_text(f"Время подачи: *{order['time']}* ✅", parse_mode="Markdown")
+    return cb.answer()
+
+@callback_router.route("timem", parse=parse_time)
+async def time_pick_minutes(cb: CallbackQuery, state: FSMContext, tm: str):
+    order = await update_order(state, OrderForm.pax, time=tm)
+
+    await cb.message.edit_text(f"Время подачи: *{order.time}* ✅", parse_mode="Markdown")
     await bot.send_message(cb.message.chat.id, "Укажите *количество человек*:", parse_mode="Markdown", reply_markup=pax_kb())
-    await state.set_state(OrderForm.pax)
-    await cb.answer("Время выбрано")
+    return cb.answer("Время выбрано")
 
 # ---- КАЛЬКУЛЯТОР (ручной ввод) ----
-async def geocode_pair(from_city: str, to_city: str) -> Optional[Tuple[Dict[str, float], Dict[str, float]]]:
-    async with aiohttp.ClientSession() as session:
-        a = await geocode_city(session, from_city)
-        b = await geocode_city(session, to_city)
-    if not a or not b:
-        return None
-    return a, b
-
 @dp.message(CalcStates.from_city, F.text)
 async def calc_from_city(message: Message, state: FSMContext):
     from_city_input = normalize_city(message.text)
     from_city_canon = resolve_from_city(from_city_input)
     from_display = guess_from_display(from_city_input) if _norm_key(from_city_canon) == "минеральные воды" else from_city_canon
-    await state.update_data(from_city=from_city_canon, from_display=from_display)
-    await state.set_state(CalcStates.to_city)
+    await update_order(state, CalcStates.to_city, from_city=from_city_canon, from_display=from_display)
     await message.answer("Введите *город прибытия* (или выберите ниже):", parse_mode="Markdown")
-    await message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
+    return message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
 
 @dp.message(CalcStates.to_city, F.text)
 async def calc_to_city(message: Message, state: FSMContext):
     try:
         to_raw = normalize_city(message.text)
-        data = await state.get_data()
-        from_city = data.get("from_city") or "Минеральные Воды"
-        from_display = data.get("from_display") or "Минеральные Воды"
+        order = await get_order(state)
+        from_city = order.from_city or "Минеральные Воды"
+        from_display = order.from_display or "Минеральные Воды"
 
         to_key = resolve_dest_key(to_raw)
 
@@ -765,10 +2184,12 @@ async def calc_to_city(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        pair = await geocode_pair(from_city, to_raw)
+        try:
+            pair = await geocode_pair(from_city, to_raw)
+        except QuoteThrottled:
+            return message.answer(THROTTLE_TEXT)
         if not pair:
-            await message.answer("❌ Не удалось определить города. Попробуйте ещё раз.")
-            return
+            return message.answer("❌ Не удалось определить города. Попробуйте ещё раз.")
         a, b = pair
         dist = haversine_km(a["lat"], a["lon"], b["lat"], b["lon"])
         p_e, p_c, p_m = per_km_prices(dist)
@@ -782,7 +2203,7 @@ async def calc_to_city(message: Message, state: FSMContext):
         await message.answer(txt, parse_mode="Markdown", reply_markup=main_menu_kb())
         await state.clear()
     except Exception as e:
-        logger.exception(f"calc_to_city failed: {e}")
+        logger.exception("calc_to_city failed: %s", e)
         await message.answer("Произошла ошибка при расчёте. Попробуйте ещё раз.", reply_markup=main_menu_kb())
         await state.clear()
 
@@ -792,50 +2213,34 @@ async def order_from_city(message: Message, state: FSMContext):
     from_city_input = normalize_city(message.text)
     from_city_canon = resolve_from_city(from_city_input)
     from_display = guess_from_display(from_city_input) if _norm_key(from_city_canon) == "минеральные воды" else from_city_canon
-    order = {"from_city": from_city_canon, "from_display": from_display}
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.to_city)
+    await update_order(state, OrderForm.to_city, from_city=from_city_canon, from_display=from_display)
     await message.answer("Введите *город прибытия* (или выберите ниже):", parse_mode="Markdown")
-    await message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
+    return message.answer("Быстрый выбор:", reply_markup=dest_suggestions_kb(0))
 
 @dp.message(OrderForm.to_city, F.text)
 async def order_to_city(message: Message, state: FSMContext):
-    data = await state.get_data(); order = data.get("order", {})
-    order["to_city"] = normalize_city(message.text)
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.date)
+    await update_order(state, OrderForm.date, to_city=normalize_city(message.text))
 
     today = date.today()
-    await message.answer("Выберите *дату подачи*:", parse_mode="Markdown", reply_markup=date_calendar_kb(today.year, today.month))
+    return message.answer("Выберите *дату подачи*:", parse_mode="Markdown", reply_markup=date_calendar_kb(today.year, today.month))
 
 @dp.message(OrderForm.date, F.text)
 async def order_date_text_fallback(message: Message, state: FSMContext):
-    order = (await state.get_data()).get("order", {})
-    order["date"] = normalize_city(message.text)
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.time)
-    await message.answer("Выберите *время подачи* — сначала выберите час:", parse_mode="Markdown", reply_markup=time_hours_kb())
+    await update_order(state, OrderForm.time, date=normalize_city(message.text))
+    return message.answer("Выберите *время подачи* — сначала выберите час:", parse_mode="Markdown", reply_markup=time_hours_kb())
 
 @dp.message(OrderForm.time, F.text)
 async def order_time_text_fallback(message: Message, state: FSMContext):
-    order = (await state.get_data()).get("order", {})
-    order["time"] = normalize_city(message.text)
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.pax)
-    await message.answer("Укажите *количество человек*:", parse_mode="Markdown", reply_markup=pax_kb())
-
-@dp.callback_query(F.data.startswith("pax:"))
-async def pax_pick(cb: CallbackQuery, state: FSMContext):
-    value = cb.data.split(":", 1)[1]  # "1".."6" или "7+"
-    data = await state.get_data()
-    order = data.get("order", {})
-    order["pax"] = "7 и более" if value == "7+" else value
-    await state.update_data(order=order)
-
-    await cb.message.edit_text(f"Пассажиров: *{order['pax']}* ✅", parse_mode="Markdown")
+    await update_order(state, OrderForm.pax, time=normalize_city(message.text))
+    return message.answer("Укажите *количество человек*:", parse_mode="Markdown", reply_markup=pax_kb())
+
+@callback_router.route("pax", parse=parse_pax)
+async def pax_pick(cb: CallbackQuery, state: FSMContext, pax: str):
+    order = await update_order(state, OrderForm.comment_choice, pax=pax)
+
+    await cb.message.edit_text(f"Пассажиров: *{order.pax}* ✅", parse_mode="Markdown")
     await bot.send_message(cb.message.chat.id, "Хотите оставить комментарий к заказу?", reply_markup=comment_choice_kb())
-    await state.set_state(OrderForm.comment_choice)
-    await cb.answer("Количество пассажиров указано")
+    return cb.answer("Количество пассажиров указано")
 
 @dp.message(OrderForm.pax, F.text)
 async def pax_text_fallback(message: Message, state: FSMContext):
@@ -846,51 +2251,38 @@ async def pax_text_fallback(message: Message, state: FSMContext):
     elif raw in {"7","7+","7 и более","7 или больше","семь","семь и более"}:
         mapped = "7 и более"
     if mapped is None:
-        await message.answer("Пожалуйста, укажите количество кнопкой или числом 1–6, либо «7 и более».", reply_markup=pax_kb())
-        return
+        return message.answer("Пожалуйста, укажите количество кнопкой или числом 1–6, либо «7 и более».", reply_markup=pax_kb())
 
-    order = (await state.get_data()).get("order", {})
-    order["pax"] = mapped
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.comment_choice)
-    await message.answer("Хотите оставить комментарий к заказу?", reply_markup=comment_choice_kb())
+    await update_order(state, OrderForm.comment_choice, pax=mapped)
+    return message.answer("Хотите оставить комментарий к заказу?", reply_markup=comment_choice_kb())
 
 # ---- КОММЕНТАРИЙ? Да/Нет ----
-@dp.callback_query(F.data == "comment_yes")
-async def comment_yes(cb: CallbackQuery, state: FSMContext):
+@callback_router.route("comment_yes")
+async def comment_yes(cb: CallbackQuery, state: FSMContext, _: str):
     await cb.message.edit_text("Оставьте комментарий к заказу (или «-», если передумали):")
     await state.set_state(OrderForm.comment)
-    await cb.answer()
+    return cb.answer()
 
-@dp.callback_query(F.data == "comment_no")
-async def comment_no(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data(); order = data.get("order", {})
-    order["comment"] = ""
-    await state.update_data(order=order)
+@callback_router.route("comment_no")
+async def comment_no(cb: CallbackQuery, state: FSMContext, _: str):
+    await update_order(state, OrderForm.phone, comment="")
     await cb.answer("Без комментария")
-    await bot.send_message(cb.message.chat.id, "Введите *номер телефона* (+7 ...):", parse_mode="Markdown")
-    await state.set_state(OrderForm.phone)
+    return cb.message.answer("Введите *номер телефона* (+7 ...):", parse_mode="Markdown")
 
 @dp.message(OrderForm.comment, F.text)
 async def order_comment(message: Message, state: FSMContext):
-    data = await state.get_data(); order = data.get("order", {})
     comment = message.text.strip()
-    order["comment"] = "" if comment == "-" else comment
-    await state.update_data(order=order)
-    await state.set_state(OrderForm.phone)
-    await message.answer("Введите *номер телефона* (+7 ...):", parse_mode="Markdown")
+    await update_order(state, OrderForm.phone, comment="" if comment == "-" else comment)
+    return message.answer("Введите *номер телефона* (+7 ...):", parse_mode="Markdown")
 
 @dp.message(OrderForm.phone, F.text)
 async def order_phone(message: Message, state: FSMContext):
     phone = message.text.strip()
     if not PHONE_RE.match(phone):
-        await message.answer("❗ Укажите корректный номер телефона (+7 999 123-45-67)")
-        return
-    data = await state.get_data(); order = data.get("order", {})
-    order["phone"] = phone
-    await state.update_data(order=order)
+        return message.answer("❗ Укажите корректный номер телефона (+7 999 123-45-67)")
+    order = await update_order(state, OrderForm.confirm, phone=phone)
 
-    prices = await compute_prices_for_order(order.get("from_city",""), order.get("to_city",""))
+    prices = await compute_prices_for_order(order.from_city, order.to_city)
     if prices is None:
         price_block = "💰 Стоимость: не удалось ориентировочно рассчитать (уточнит диспетчер)."
     else:
@@ -899,92 +2291,365 @@ async def order_phone(message: Message, state: FSMContext):
 
     txt = (
         f"Проверьте данные заказа:\n\n"
-        f"Откуда: *{order.get('from_display', order.get('from_city',''))}*\n"
-        f"Куда: *{order.get('to_city','')}*\n"
-        f"Дата: *{order.get('date','')}*\n"
-        f"Время: *{order.get('time','')}*\n"
-        f"Пассажиров: *{order.get('pax','')}*\n"
-        f"Телефон: *{order.get('phone','')}*\n"
-        f"Комментарий: {order.get('comment') or '—'}\n\n"
+        f"Откуда: *{order.from_display or order.from_city}*\n"
+        f"Куда: *{order.to_city}*\n"
+        f"Дата: *{order.date}*\n"
+        f"Время: *{order.time}*\n"
+        f"Пассажиров: *{order.pax}*\n"
+        f"Телефон: *{order.phone}*\n"
+        f"Комментарий: {order.comment or '—'}\n\n"
         "⚠️ *Стоимость предварительная, окончательная цена оговаривается с диспетчером!*\n\n"
         f"{price_block}\n\n"
         "Подтвердить?"
     )
-    await state.set_state(OrderForm.confirm)
-    await message.answer(txt, parse_mode="Markdown", reply_markup=confirm_order_kb())
+    return message.answer(txt, parse_mode="Markdown", reply_markup=confirm_order_kb())
 
-@dp.callback_query(F.data.in_(["order_confirm", "order_edit", "order_cancel"]))
-async def order_finish(cb: CallbackQuery, state: FSMContext):
-    action = cb.data
+@callback_router.route("order_confirm", "order_edit", "order_cancel")
+async def order_finish(cb: CallbackQuery, state: FSMContext, action: str):
     if action == "order_cancel":
         await state.clear()
         await cb.message.edit_text("❌ Заказ отменён.")
         await cb.answer()
-        await bot.send_message(cb.message.chat.id, "Вы в главном меню:", reply_markup=main_menu_kb())
-        return
+        return cb.message.answer("Вы в главном меню:", reply_markup=main_menu_kb())
     if action == "order_edit":
         await state.clear()
         await cb.message.edit_text("Изменим заказ. Введите снова город отправления (или выберите ниже):")
         await state.set_state(OrderForm.from_city)
         await bot.send_message(cb.message.chat.id, "Быстрый выбор:", reply_markup=from_suggestions_kb())
-        await cb.answer()
-        return
+        return cb.answer()
 
-    data = await state.get_data(); order = data.get("order", {})
+    order = await get_order(state)
     await state.clear()
 
     await cb.message.edit_text("✅ Спасибо, Ваша заявка принята! В ближайшее время с Вами свяжется диспетчер.")
     await bot.send_message(cb.message.chat.id, "Вы в главном меню:", reply_markup=main_menu_kb())
     await cb.answer("Заявка отправлена")
+    schedule_order_reminders(order, cb.message.chat.id)
+
+    if ADMIN_CHAT_ID:
+        # Уведомление диспетчеру уходит в фоне: пользователь не ждёт расчёт цены
+        spawn(notify_admin_order(order, cb.from_user))
 
+async def notify_admin_order(order: Order, user: User) -> None:
+    # Цена для диспетчера уже посчитана при подтверждении — квоту пользователя повторно не списываем
+    rate_user.set(None)
     price_text = ""
-    prices = await compute_prices_for_order(order.get("from_city",""), order.get("to_city",""))
+    prices = await compute_prices_for_order(order.from_city, order.to_city)
     if prices is not None:
         e, c, m, _ = prices
         price_text = "\n\nОриентировочно:\n" + prices_text_total_only(e, c, m)
 
-    if ADMIN_CHAT_ID:
-        try:
-            user = cb.from_user
-            txt = (
-                f"🆕 *Заявка на заказ*\n\n"
-                f"От: *{order.get('from_display', order.get('from_city',''))}* → *{order.get('to_city','')}*\n"
-                f"Дата: *{order.get('date','')}*, Время: *{order.get('time','')}*\n"
-                f"Пассажиров: *{order.get('pax','')}*\n"
-                f"Телефон: *{order.get('phone','')}*\n"
-                f"Комментарий: {order.get('comment') or '—'}"
-                f"{price_text}\n\n"
-                f"👤 {user.full_name} (id={user.id})"
-            )
-            await bot.send_message(ADMIN_CHAT_ID, txt, parse_mode="Markdown")
-        except Exception as e:
-            logger.warning(f"Failed to notify admin: {e}")
+    try:
+        txt = (
+            f"🆕 *Заявка на заказ*\n\n"
+            f"От: *{order.from_display or order.from_city}* → *{order.to_city}*\n"
+            f"Дата: *{order.date}*, Время: *{order.time}*\n"
+            f"Пассажиров: *{order.pax}*\n"
+            f"Телефон: *{order.phone}*\n"
+            f"Комментарий: {order.comment or '—'}"
+            f"{price_text}\n\n"
+            f"👤 {user.full_name} (id={user.id})"
+        )
+        await bot.send_message(ADMIN_CHAT_ID, txt, parse_mode="Markdown")
+    except Exception as e:
+        logger.warning("Failed to notify admin: %s", e)
 
 # ---- ИНФОРМАЦИЯ ----
 @dp.message(F.text == BTN_INFO)
 async def info_handler(message: Message):
-    await message.answer(
+    return message.answer(
         "🚕 TransferAir междугороднее такси (Трансфер) из Минеральных Вод.\n\n"
         "🤖 Вы можете заказать трансфер через бота.\n\n"
         "📞 Позвонить нам: +79340241414\n\n"
         "🌐 Посетить наш сайт: https://transferkmw.ru",
     )
 
+# ================== ПРОФИЛИРОВАНИЕ ==================
+FrameKey = Tuple[str, int, str]  # (файл, первая строка функции, имя) — как ключи в pstats
+
+class SamplingProfiler:
+    # Отдельный поток раз в interval снимает стек потока event loop через sys._current_frames().
+    # В цикл и хендлеры ничего не встраивается: без активного профиля стоимость нулевая.
+    def __init__(self, interval: float, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._busy = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._busy.locked()
+
+    def _stack(self, thread_id: int) -> Optional[Tuple[FrameKey, ...]]:
+        frame = sys._current_frames().get(thread_id)
+        stack: List[FrameKey] = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()  # от корня к листу
+        return tuple(stack) if stack else None
+
+    def sample(self, thread_id: int, seconds: float) -> Dict[Tuple[FrameKey, ...], int]:
+        # Блокирующий: вызывается через asyncio.to_thread
+        counts: Dict[Tuple[FrameKey, ...], int] = {}
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            stack = self._stack(thread_id)
+            if stack is not None:
+                counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(self.interval)
+        return counts
+
+    async def run(self, seconds: float) -> Dict[Tuple[FrameKey, ...], int]:
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("profiler is busy")
+        try:
+            return await asyncio.to_thread(self.sample, threading.get_ident(), seconds)
+        finally:
+            self._busy.release()
+
+    @staticmethod
+    def collapsed(counts: Dict[Tuple[FrameKey, ...], int]) -> bytes:
+        # Формат Brendan Gregg (flamegraph.pl, speedscope): «a;b;c count»
+        lines = []
+        for stack, n in counts.items():
+            names = ";".join(f"{name} ({os.path.basename(path)}:{line})" for path, line, name in stack)
+            lines.append(f"{names} {n}")
+        lines.sort()
+        return ("\n".join(lines) + "\n").encode()
+
+    def pstats(self, counts: Dict[Tuple[FrameKey, ...], int]) -> bytes:
+        # Те же сэмплы в формате cProfile (marshal словаря stats): читается pstats.Stats, snakeviz.
+        # Время — число сэмплов * interval; nc — число сэмплов, где функция была на стеке.
+        stats: Dict[FrameKey, List[Any]] = {}
+        for stack, n in counts.items():
+            dt = n * self.interval
+            seen = set()
+            for i, key in enumerate(stack):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += n
+                    entry[1] += n
+                    entry[3] += dt
+                if i == len(stack) - 1:
+                    entry[2] += dt
+                if i:
+                    caller = entry[4].setdefault(stack[i - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += n
+                    caller[1] += n
+                    caller[3] += dt
+                    if i == len(stack) - 1:
+                        caller[2] += dt
+        return marshal.dumps({
+            key: (cc, nc, tt, ct, {c: tuple(v) for c, v in callers.items()})
+            for key, (cc, nc, tt, ct, callers) in stats.items()
+        })
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+# ================== ЗДОРОВЬЕ EVENT LOOP ==================
+class LoopMonitor:
+    # Корутина раз в interval меряет, насколько позже запланированного она проснулась (lag).
+    # Сторожевой поток смотрит на «пульс» корутины: если loop не отвечает дольше порога,
+    # пишет в лог стек потока loop — то есть код, который его блокирует.
+    def __init__(self, interval: float, block_threshold: float):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self._heartbeat = time.monotonic()
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    @property
+    def stall(self) -> float:
+        # Сколько loop не отвечает прямо сейчас (0 — отвечает вовремя)
+        return max(0.0, time.monotonic() - self._heartbeat - self.interval)
+
+    @property
+    def current_lag(self) -> float:
+        return max(self.lag, self.stall)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "lag_ms": round(self.current_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "blocked": self.blocked,
+        }
+
+    def _watchdog(self) -> None:
+        reported = 0.0
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            if heartbeat == reported or self.stall < self.block_threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            reported = heartbeat
+            self.blocked += 1
+            logger.warning(
+                "Event loop blocked for %.0f ms:\n%s",
+                self.stall * 1000, "".join(traceback.format_stack(frame, limit=20)),
+            )
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._heartbeat = time.monotonic()
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                started = loop.time()
+                await asyncio.sleep(self.interval)
+                self.lag = max(0.0, loop.time() - started - self.interval)
+                self.max_lag = max(self.max_lag, self.lag)
+                self._heartbeat = time.monotonic()
+        finally:
+            self._stop.set()
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL, LOOP_BLOCK_THRESHOLD)
+
 # ================== FASTAPI + WEBHOOK ==================
 app = FastAPI()
 
+# Типы апдейтов, на которые есть хендлеры; остальные подтверждаем без валидации
+HANDLED_UPDATE_TYPES = frozenset(dp.resolve_used_update_types())
+OK_BODY = orjson.dumps({"ok": True})
+
+def ok_response() -> Response:
+    return Response(content=OK_BODY, media_type="application/json")
+
+def webhook_reply_body(method: TelegramMethod[Any]) -> Optional[bytes]:
+    # Bot API принимает вызов метода в ответе на вебхук: {"method": ..., параметры}
+    files: Dict[str, Any] = {}
+    payload: Dict[str, Any] = {"method": method.__api_method__}
+    for key, value in method.model_dump(warnings=False).items():
+        value = bot.session.prepare_value(value, bot=bot, files=files, _dumps_json=False)
+        if value is not None:
+            payload[key] = value
+    if files:
+        # Файлы в JSON-ответе не передать
+        return None
+    return orjson.dumps(payload)
+
+def parse_update(body: bytes) -> Optional[Update]:
+    data = orjson.loads(body)
+    if not HANDLED_UPDATE_TYPES.intersection(data):
+        return None
+    # context с ботом: иначе feed_update пересоздаёт Update через model_dump + повторную валидацию
+    return Update.model_validate(data, context={"bot": bot})
+
 @app.get("/")
 async def healthcheck():
     return {"status": "ok"}
 
+@app.get("/healthz")
+async def liveness():
+    # Ответ сам по себе означает, что loop жив
+    return {"status": "ok", "loop": loop_monitor.snapshot()}
+
+def readiness_checks() -> Dict[str, Dict[str, Any]]:
+    log_queue = log_listener.queue
+    log_fill = log_queue.qsize() / log_queue.maxsize if log_queue.maxsize else 0.0
+    circuit = nominatim_circuit.state
+    return {
+        "draining": {"ok": not inflight.draining},
+        "webhook": {"ok": webhook_registered.is_set()},
+        "loop": {"ok": loop_monitor.current_lag <= READY_MAX_LOOP_LAG, **loop_monitor.snapshot()},
+        # Nominatim общий для всех инстансов: открытый предохранитель — повод снять трафик,
+        # только если нет офлайн-индекса и расчёт цены работает лишь по фиксированным ценам
+        "geocoder": {"ok": circuit != "open" or geo_index is not None, "nominatim": circuit,
+                     "geonames": geo_index is not None},
+        "queues": {"ok": inflight.count <= READY_MAX_INFLIGHT and log_fill < READY_MAX_LOG_QUEUE,
+                   "inflight": inflight.count, "log_queue": log_queue.qsize(),
+                   "log_dropped": sum(getattr(h, "dropped", 0) for h in logging.getLogger().handlers)},
+    }
+
+@app.get("/readyz")
+async def readiness():
+    checks = readiness_checks()
+    ready = all(c["ok"] for c in checks.values())
+    body = orjson.dumps({"status": "ready" if ready else "not_ready", "checks": checks})
+    return Response(content=body, status_code=200 if ready else 503, media_type="application/json")
+
+@app.get(f"/stats/{{secret}}")
+async def stats(secret: str):
+    if not WEBHOOK_SECRET or secret != WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="forbidden")
+    return {"bot_session": bot_session.stats.snapshot(), "reminders": {"pending": reminders.size}}
+
+@app.get(f"/debug/profile/{{secret}}")
+async def debug_profile(secret: str, seconds: float = 10, format: str = "collapsed"):
+    if not WEBHOOK_SECRET or secret != WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="forbidden")
+    if format not in ("collapsed", "pstats"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or pstats")
+    if profiler.busy:
+        raise HTTPException(status_code=409, detail="profiler is busy")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    try:
+        counts = await profiler.run(seconds)
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="profiler is busy")
+    logger.info("Profile taken: %.1fs, %d samples", seconds, sum(counts.values()))
+    if format == "pstats":
+        return Response(
+            content=profiler.pstats(counts), media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="tgbot.prof"'},
+        )
+    return Response(content=profiler.collapsed(counts), media_type="text/plain")
+
 @app.post(f"/webhook/{{secret}}")
 async def telegram_webhook(secret: str, request: Request):
     if WEBHOOK_SECRET and secret != WEBHOOK_SECRET:
         raise HTTPException(status_code=403, detail="forbidden")
-    data = await request.json()
-    update = Update.model_validate(data)
-    await dp.feed_update(bot, update)
-    return {"ok": True}
+    if inflight.draining:
+        # Telegram повторит доставку — апдейт заберёт новый инстанс
+        raise HTTPException(status_code=503, detail="draining", headers={"Retry-After": "1"})
+    inflight.enter()
+    try:
+        with trace_root("telegram_webhook") as sp:
+            try:
+                update = parse_update(await request.body())
+            except (ValueError, TypeError) as e:
+                logger.warning("Bad webhook payload: %s", e)
+                raise HTTPException(status_code=400, detail="bad request")
+            if update is None:
+                return ok_response()
+            log_update_id.set(update.update_id)
+            log_chat_id.set(update_chat_id(update))
+            if sp is not None:
+                sp.set("update_id", update.update_id)
+            result = await dp.feed_update(bot, update)
+            if isinstance(result, TelegramMethod):
+                body = webhook_reply_body(result) if WEBHOOK_REPLY else None
+                if body is not None:
+                    if sp is not None:
+                        sp.set("webhook_reply", result.__api_method__)
+                    return Response(content=body, media_type="application/json")
+                await bot(result)
+            elif asyncio.iscoroutine(result):
+                # Хендлер вернул корутину (например, bot.send_message(...)) — не теряем вызов
+                await result
+    finally:
+        inflight.exit()
+    return ok_response()
+
+def update_chat_id(update: Update) -> Optional[int]:
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None:
+        msg = update.callback_query.message
+        return msg.chat.id if msg is not None else update.callback_query.from_user.id
+    return None
+
+# Долгоживущие фоновые циклы (вебхук, чистка FSM) — отменяются первыми при остановке
+_service_tasks: List[asyncio.Task] = []
+webhook_registered = asyncio.Event()
 
 async def _set_webhook_with_retry():
     if not APP_BASE_URL:
@@ -994,22 +2659,92 @@ async def _set_webhook_with_retry():
     while True:
         try:
             await bot.set_my_commands([BotCommand(command="start", description="Запуск")])
-            await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=True)
+            await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=not ROLLING_RESTART,
+                                  allowed_updates=sorted(HANDLED_UPDATE_TYPES))
             logger.info("Webhook set to %s", url)
+            webhook_registered.set()
             break
         except Exception as e:
             logger.warning("Webhook not set yet (%s). Retrying soon…", e)
             await asyncio.sleep(30)
 
+def install_drain_signal_handler() -> None:
+    # uvicorn по SIGTERM сразу закрывает порт, и до on_shutdown ни один запрос уже не дойдёт.
+    # Поэтому сначала сами включаем draining (вебхук отвечает 503, /readyz — not ready),
+    # и лишь через SHUTDOWN_READINESS_DELAY передаём сигнал обработчику uvicorn.
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        return  # не под uvicorn (или не в главном потоке) — оставляем как есть
+    loop = asyncio.get_running_loop()
+
+    def start_drain(sig: int) -> None:
+        logger.info("SIGTERM: draining, stopping in %.1fs", SHUTDOWN_READINESS_DELAY)
+        loop.call_later(SHUTDOWN_READINESS_DELAY, previous, sig, None)
+
+    def on_sigterm(sig: int, frame: Any) -> None:
+        # Только флаг и call_soon_threadsafe: сигнал может прийти, пока главный поток держит
+        # блокировку очереди логов, и logger.info здесь повис бы на ней навсегда
+        if inflight.draining:
+            previous(sig, frame)  # повторный SIGTERM — не ждём
+            return
+        inflight.draining = True
+        loop.call_soon_threadsafe(start_drain, sig)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
 @app.on_event("startup")
 async def on_startup():
-    asyncio.create_task(_set_webhook_with_retry())
+    global geo_index
+    install_drain_signal_handler()
+    span_exporter.start()
+    user_registry.load()
+    broadcaster.resume()
+    reminders.load()
+    try:
+        geo_index = await asyncio.to_thread(load_geo_index)
+    except Exception as e:
+        logger.warning("GeoNames index unavailable: %s", e)
+    _service_tasks.append(asyncio.create_task(fsm_sweeper()))
+    _service_tasks.append(asyncio.create_task(loop_monitor.run()))
+    _service_tasks.append(asyncio.create_task(reminders.run()))
+    _service_tasks.append(asyncio.create_task(_set_webhook_with_retry()))
     logger.info("Startup complete. Waiting for webhook setup…")
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    try:
-        await bot.delete_webhook(drop_pending_updates=False)
-        logger.info("Webhook removed")
-    except Exception as e:
-        logger.warning(f"Failed to delete webhook: {e}")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+    inflight.draining = True
+    for t in _service_tasks:
+        t.cancel()
+
+    # Входящие запросы к этому моменту уже дождался uvicorn; дожидаемся исходящих
+    pending = [t for t in _background_tasks if not t.done()]
+    if pending:
+        _, not_done = await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()))
+        if not_done:
+            logger.warning("Drain timeout: %d outbound task(s) cancelled", len(not_done))
+            for t in not_done:
+                t.cancel()
+            # Даём отменённым задачам отработать (напоминания перезаписываются в журнал)
+            await asyncio.gather(*not_done, return_exceptions=True)
+
+    if ROLLING_RESTART:
+        logger.info("Rolling restart: webhook kept, pending updates stay queued in Telegram")
+    else:
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+            logger.info("Webhook removed")
+        except Exception as e:
+            logger.warning("Failed to delete webhook: %s", e)
+    await bot.session.close()
+    if _http_session is not None:
+        await _http_session.close()
+    if geo_index is not None:
+        geo_index.close()
+    user_registry.close()
+    reminders.close()
+    span_exporter.stop()
+    log_listener.stop()
+    # Последние записи uvicorn («Application shutdown complete» …) пишем уже напрямую
+    logging.getLogger().handlers[:] = list(log_listener.handlers)
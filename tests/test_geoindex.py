@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geoindex import GeoIndex, build_index, normalize_name  # noqa: E402
+
+# geonameid, name, asciiname, alternatenames, lat, lon, feature class, code, country, ..., population
+DUMP_ROWS = [
+    ("1", "Yessentuki", "Yessentuki", "Ессентуки,Essentuki", "44.04", "42.86", "RU", "100000"),
+    ("2", "Nal'chik", "Nal'chik", "Нальчик", "43.49", "43.61", "RU", "240000"),
+    ("3", "Orël", "Orel", "", "42.00", "40.00", "RU", "300000"),
+    ("4", "Gəncə", "Ganja", "Гянджа", "40.68", "46.36", "AZ", "330000"),
+    ("5", "Pyatigorsk", "Pyatigorsk", "Пятигорск", "44.05", "43.06", "RU", "145000"),
+    ("6", "Pyatigorsk", "Pyatigorsk", "", "44.10", "43.00", "RU", "50"),
+]
+
+@pytest.mark.parametrize("a, b", [
+    ("Нальчик", "Nal'chik"),
+    ("Nal’chik", "nalchik"),
+    ("Ессентуки", "Yessentuki"),
+    ("Ейск", "Yeysk"),
+    ("Подъёлки", 'Pod"yelki'),
+    ("Orël", "orel"),
+    ("село Архыз", "Arkhyz"),
+])
+def test_normalize_name_same_key(a, b):
+    assert normalize_name(a) == normalize_name(b) != ""
+
+@pytest.mark.parametrize("name", ["Gəncə", "თბილისი", "", "   "])
+def test_normalize_name_rejects_untransliterable(name):
+    assert normalize_name(name) == ""
+
+@pytest.fixture
+def index(tmp_path):
+    dump = tmp_path / "dump.txt"
+    with open(dump, "w", encoding="utf-8") as f:
+        for gid, name, ascii_name, alt, lat, lon, country, pop in DUMP_ROWS:
+            row = [gid, name, ascii_name, alt, lat, lon, "P", "PPL", country] + [""] * 5 + [pop]
+            f.write("\t".join(row) + "\n")
+    path = str(tmp_path / "geo.idx")
+    build_index(str(dump), path)
+    idx = GeoIndex(path)
+    yield idx
+    idx.close()
+
+@pytest.mark.parametrize("query, lat", [
+    ("Ессентуки", 44.04), ("Нальчик", 43.49), ("nalchik", 43.49), ("Orel", 42.0), ("Гянджа", 40.68), ("Ganja", 40.68), ("Москва", None),
+])
+def test_lookup(index, query, lat):
+    hit = index.lookup(query)
+    if lat is None:
+        assert hit is None
+    else:
+        assert hit is not None and hit[0] == pytest.approx(lat, abs=1e-4)
+
+def test_lookup_prefers_largest_place(index):
+    assert index.lookup("Пятигорск")[2] == 145000
+
+def test_lookup_no_fragment_matches(index):
+    # «nc» — то, что раньше оставалось от «Gəncə»
+    assert index.lookup("nc") is None
+    assert index.lookup("or l") is None